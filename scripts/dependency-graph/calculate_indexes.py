@@ -1,10 +1,12 @@
 from sklearn.metrics import silhouette_score
-from kshape import kshape, _sbd
+from kshape import kshape, zscore, _sbd, _sbd_pdist, _squareform
 from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 import metadata
+import sbd_cache
+import cluster_artifact
 import sys, os
 
 def gap(centroids, data, labels, refs=None, nrefs=20, ks=range(1,11)):
@@ -29,7 +31,7 @@ def gap(centroids, data, labels, refs=None, nrefs=20, ks=range(1,11)):
 
     gaps = np.zeros((len(ks),))
     for (i,k) in enumerate(ks):
-        disp = sum(_sbd([data[m,:], centroids[labels[m],:]) for m in range(shape[0])])
+        disp = sum(_sbd(data[m,:], centroids[labels[m],:])[0] for m in range(shape[0]))
 
         refdisps = np.zeros((rands.shape[2],))
         for j in range(rands.shape[2]):
@@ -39,27 +41,33 @@ def gap(centroids, data, labels, refs=None, nrefs=20, ks=range(1,11)):
         gaps[i] = np.log(np.mean(refdisps))- np.log(disp)
     return gaps
 
-def process_service(path, service_name, res):
+def service_distances(path, service):
+  """
+  pairwise SBD of all z-scored metrics of the preprocessed file of service
+  as square matrix and the metric names, from the sbd_cache if possible
+  """
+  filename = os.path.join(path, service["preprocessed_filename"])
+  key = sbd_cache.key(filename)
+  distances = sbd_cache.load(path, key)
+  if distances is None:
+      df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+      distances = _sbd_pdist(np.array([zscore(df[c]) for c in df.columns]))
+      sbd_cache.store(path, key, distances)
+      columns = df.columns
+  else:
+      columns = pd.read_csv(filename, sep="\t", index_col='time', nrows=0).columns
+  return _squareform(distances, len(columns)), list(columns)
+
+def process_service(path, service, res):
+  service_name = service["name"]
   scores = []
   for i in range(2, 8):
-      centroids = []
-      metrics = []
-      labels = []
-      for j in range(i):
-          name = "%s-cluster-%d_%d.tsv" % (service_name, i, j + 1)
-          cluster_path = os.path.join(path, name)
-          df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
-          centroids.append(df.columns[0])
-          for idx, c in enumerate(df.columns[1:]):
-              metrics.append(df[c])
-              labels.append(j)
-      distances = np.zeros([len(metrics), len(metrics)])
-      for idx_a, metric_a in enumerate(metrics):
-          for idx_b, metric_b in enumerate(metrics):
-              distances[idx_a, idx_b] = _sbd(metric_a, metric_b)[0]
-      labels = np.array(labels)
+      artifact = cluster_artifact.load(cluster_artifact.name(path, service_name, i))
+      centroids = artifact.centroids
+      metrics = artifact.series
+      labels = artifact.labels
       # def gap(centroids, data, labels, refs=None, nrefs=20, ks=range(1,11)):
-      score = gap(centroids, np.array(metrics), labels)
+      score = gap(centroids, metrics, labels)
       #if len(np.unique(labels)) == 1:
       #    score = -1
       #else:
@@ -79,7 +87,7 @@ def main(path):
     data = metadata.load(path)
     result = defaultdict(list)
     for srv in data["services"]:
-        process_service(path, srv["name"], result)
+        process_service(path, srv, result)
     n = os.path.join(path, "scores.tsv")
     print(n)
     pd.DataFrame(result).to_csv(n)
@@ -1,5 +1,7 @@
 import os
 import sys
+import math
+import time
 import json
 import argparse
 import multiprocessing as mp 
@@ -12,22 +14,37 @@ from metricsnamecluster import cluster_words
 import metrics_utils as msu
 
 import graphs
-from kshape import kshape, zscore, _sbd
+from kshape import (kshape, minibatch_kshape, multiresolution_kshape, incremental_kshape,
+                    bisecting_kshape, partitioned_kshape, simplified_silhouette, zscore, paa,
+                    _sbd_pdist, _squareform, _margins, SpectralCache)
 import metadata
+import sbd_cache
+import cluster_artifact
+import dedup
+import shared_dataset
 
 from collections import defaultdict
 
-metadata_lock = mp.Lock()
-
-def silhouette_score(series, clusters):
-    distances = np.zeros((series.shape[0], series.shape[0]))
-    for idx_a, metric_a in enumerate(series):
-        for idx_b, metric_b in enumerate(series):
-            distances[idx_a, idx_b] = _sbd(metric_a, metric_b)[0]
-    labels = np.zeros(series.shape[0])
+# switch to mini-batch k-shape above this many samples (metrics x time)
+MINIBATCH_THRESHOLD = 2000000
+# number of metrics per chunk fed to mini-batch k-shape
+MINIBATCH_CHUNK_SIZE = 256
+# maximum number of metrics per partition of two-level k-shape
+PARTITION_SIZE = 64
+# PAA factor of the coarse k-shape run that partitions metrics by shape
+PARTITION_COARSEN = 10
+
+def cluster_labels(clusters, size):
+    labels = np.zeros(size)
     for i, (cluster, indicies) in enumerate(clusters):
         for index in indicies:
             labels[index] = i
+    return labels
+
+def silhouette_score(series, clusters, distances=None):
+    if distances is None:
+        distances = _squareform(_sbd_pdist(series), len(series))
+    labels = cluster_labels(clusters, series.shape[0])
 
     # silhouette is only defined, if we have 2 clusters with assignments at 
     # minimum
@@ -37,36 +54,172 @@ def silhouette_score(series, clusters):
     else:
         return labels, _silhouette_score(distances, labels, metric='precomputed')
 
-def do_kshape(name_prefix, df, cluster_size, initial_clustering=None):
-    columns = df.columns
-    matrix = []
-    for c in columns:
-        matrix.append(zscore(df[c]))
-    res = kshape(matrix, cluster_size, initial_clustering)
-    labels, score = silhouette_score(np.array(matrix), res)
+def do_kshape(name_prefix, df, cluster_size, initial_clustering=None, n_init=1, seeding="random",
+              minibatch_threshold=MINIBATCH_THRESHOLD, dtype=None, coarsen=1, max_shift=None,
+              matrix=None, cache=None, initial_centroids=None, silhouette="exact",
+              partitions=None, partition_jobs=1, duplicates=None, restart_jobs=1):
+    """
+    matrix (the z-scored columns of df) and cache (its SpectralCache) can be
+    shared between calls for different cluster sizes. the result is written
+    to name_prefix.npz (see cluster_artifact). initial_centroids (see
+    get_initial_centroids) warm-start k-shape. with partitions (see
+    metric_partitions), two-level k-shape clusters every partition in one of
+    partition_jobs threads and merges their centroids. see write_clustering
+    for duplicates. the n_init restarts run in restart_jobs threads.
+    """
+    if matrix is None:
+        matrix = zscore_matrix(df, dtype)
+    if cache is None:
+        cache = SpectralCache(matrix, dtype, max_shift)
+
+    # neither two-level nor mini-batch k-shape can start from an initial assigment
+    if initial_clustering is None and initial_centroids is None and partitions is not None:
+        res, info = partitioned_kshape(matrix, cluster_size, partitions, cache, n_init=n_init,
+                                       seeding=seeding, n_jobs=partition_jobs, dtype=dtype,
+                                       return_info=True)
+        for stage, seconds in info["stages"]:
+            print("%s %s stage: %.2fs" % (name_prefix, stage, seconds))
+    elif initial_clustering is None and initial_centroids is None and df.size > minibatch_threshold:
+        chunks = [matrix[i:i + MINIBATCH_CHUNK_SIZE] for i in range(0, len(matrix), MINIBATCH_CHUNK_SIZE)]
+        res, info = minibatch_kshape(chunks, cluster_size, dtype=dtype, return_info=True,
+                                     max_shift=cache.max_shift)
+        print("%s mini-batch: %d passes, %d batches, %.2fs, sbd %f"
+              % (name_prefix, info["passes"], info["batches"], info["time"], info["sbd"]))
+    else:
+        if coarsen > 1:
+            res, info = multiresolution_kshape(matrix, cluster_size, coarsen,
+                                               initial_clustering=initial_clustering, cache=cache,
+                                               n_init=n_init, seeding=seeding,
+                                               n_jobs=restart_jobs, dtype=dtype, return_info=True,
+                                               initial_centroids=initial_centroids)
+            for stage, seconds in info["stages"]:
+                print("%s %s stage: %.2fs" % (name_prefix, stage, seconds))
+        else:
+            res, info = kshape(matrix, cluster_size, initial_clustering, cache,
+                               n_init=n_init, seeding=seeding, n_jobs=restart_jobs, dtype=dtype,
+                               return_info=True, initial_centroids=initial_centroids)
+        for i, restart in enumerate(info["restarts"]):
+            print("%s restart %d: %d iterations, %.2fs, sbd %f, %d distances pruned, %d centroids extracted"
+                  % (name_prefix, i, restart["iterations"], restart["time"], restart["sbd"],
+                     sum(restart["pruned"]), sum(restart["extracted"])))
+    return write_clustering(name_prefix, df, matrix, res, cache, silhouette=silhouette,
+                            duplicates=duplicates)
+
+def do_incremental(name_prefix, df, previous, margin_threshold=0.05, matrix=None, cache=None,
+                   silhouette="exact", duplicates=None):
+    """
+    update the clustering previous (a cluster_artifact of a shorter window)
+    to all samples of df (see kshape.incremental_kshape). metrics that are
+    new in df count as unstable.
+    """
+    if matrix is None:
+        matrix = zscore_matrix(df)
+    if cache is None:
+        cache = SpectralCache(matrix)
+    positions = dict((c, i) for i, c in enumerate(previous.columns))
+    labels = np.empty(len(df.columns), dtype=int)
+    labels.fill(-1)
+    margins = np.zeros(len(df.columns))
+    for i, c in enumerate(df.columns):
+        if c in positions:
+            labels[i] = previous.labels[positions[c]]
+            margins[i] = previous.margin[positions[c]]
+
+    res, margins, info = incremental_kshape(matrix, labels, previous.centroids, margins,
+                                            margin_threshold, cache, return_info=True)
+    print("%s incremental: %d samples appended, %d metrics reassigned, %d moved"
+          % (name_prefix, len(df) - len(previous.time), info["reassigned"], info["moved"]))
+    return write_clustering(name_prefix, df, matrix, res, cache, margins, silhouette, duplicates)
+
+def write_clustering(name_prefix, df, matrix, res, cache, margins=None, silhouette="exact",
+                     duplicates=None):
+    """
+    score a clustering and write it to name_prefix.npz. without margins, the
+    distances of all metrics to all centroids are computed for them,
+    otherwise only the distances to their own centroid. the scores are
+    returned as dict: the simplified silhouette score (from the distances
+    to the centroids) is always computed, the exact one (from all pairwise
+    distances) only if silhouette is "exact". if df and matrix only hold the
+    representatives of duplicates (see dedup.Duplicates), the scores are
+    those of the representatives, but all metrics are written.
+    """
+    scores = {}
+    if silhouette == "exact":
+        labels, score = silhouette_score(matrix, res, cache.sbd_matrix())
+        # numpy scalars (e.g. float32 with --dtype float32) are not json serializable
+        scores["silhouette_score"] = float(score)
+    else:
+        labels = cluster_labels(res, len(df.columns))
+
+    # distance and alignment of every metric to its own centroid
+    labels = labels.astype(int)
+    centroids = np.array([centroid for centroid, _ in res])
+    if margins is None:
+        ncc, shift = cache.ncc_c(centroids)
+        margins = _margins(1 - ncc, labels)
+        rows = np.arange(len(labels))
+        ncc, shift = ncc[rows, labels], shift[rows, labels]
+    else:
+        ncc = np.zeros(len(labels))
+        shift = np.zeros(len(labels), dtype=int)
+        for j in range(len(centroids)):
+            members = np.flatnonzero(labels == j)
+            if len(members):
+                own_ncc, own_shift = cache.ncc_c(centroids[j:j + 1], members)
+                ncc[members] = own_ncc[:, 0]
+                shift[members] = own_shift[:, 0]
+    scores["simplified_silhouette_score"] = float(simplified_silhouette(1 - ncc, margins, labels))
+
+    if duplicates is not None:
+        # duplicates share cluster, distance and shift of their representative
+        labels, ncc, shift, margins = [duplicates.expand(a) for a in (labels, ncc, shift, margins)]
+        df, matrix = duplicates.df, duplicates.matrix
 
     # keep a reference of which metrics are in each cluster
     cluster_metrics = defaultdict(list)
     # we keep it in a dict: cluster_metrics[<cluster_nr>]{<metric_a>, <metric_b>}
-    for i, col in enumerate(columns):
+    for i, col in enumerate(df.columns):
         cluster_metrics[int(labels[i])].append(col)
 
-    filenames = []
-    for i, (centroid, assigned_series) in enumerate(res):
-        d = {}
-        for serie in assigned_series:
-            d[columns[serie]] = pd.Series(matrix[serie], index=df.index)
-        d["centroid"] = pd.Series(centroid, index=df.index)
-        df2 = pd.DataFrame(d)
-        figure = df2.plot()
-        figure.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        name = "%s_%d" % (name_prefix, (i+1))
-        filename = name + ".tsv.gz"
-        print(filename)
-        df2.to_csv(filename, sep="\t", compression='gzip')
-        filenames.append(os.path.basename(filename))
-        graphs.write(df2, name + ".png")
-    return cluster_metrics, score, filenames
+    filename = name_prefix + ".npz"
+    print(filename)
+    cluster_artifact.write(filename, df.index, df.columns, matrix, labels, centroids,
+                           1 - ncc, -shift, margins)
+    return cluster_metrics, scores, filename
+
+def metric_partitions(df, service_name, matrix, mode="names", partition_size=PARTITION_SIZE,
+                      dtype=None, max_shift=None):
+    """
+    partition the metrics of df for two-level k-shape, either by their names
+    (see metricsnamecluster.cluster_words) or by a k-shape run on the PAA of
+    matrix (their z-scored series, aligned within max_shift scaled down to
+    the PAA). partitions larger than partition_size are split up. returns
+    lists of rows of matrix.
+    """
+    size = int(math.ceil(float(len(df.columns)) / partition_size))
+    if mode == "names":
+        groups = cluster_words(list(df.columns), service_name, size)
+    elif mode == "sbd":
+        coarse = zscore(paa(matrix, PARTITION_COARSEN), axis=1, dtype=dtype)
+        coarse_shift = None
+        if max_shift is not None:
+            coarse_shift = -(-max_shift // PARTITION_COARSEN)
+        groups = [series for _, series in kshape(coarse, size, seeding="kshape++", random_state=0,
+                                                 max_shift=coarse_shift)]
+    else:
+        raise ValueError("unknown partitioning: %s" % mode)
+    partitions = []
+    for group in groups:
+        group = sorted(group)
+        for i in range(0, len(group), partition_size):
+            partitions.append(group[i:i + partition_size])
+    return partitions
+
+def zscore_matrix(df, dtype=None):
+    matrix = []
+    for c in df.columns:
+        matrix.append(zscore(df[c], dtype=dtype))
+    return np.array(matrix)
 
 def get_initial_clustering(service, metadata, metrics):
 
@@ -96,41 +249,211 @@ def get_initial_clustering(service, metadata, metrics):
 
     return initial_idx
 
-def cluster_service(path, service, cluster_size, prev_metadata=None):
-
+def get_initial_centroids(service, metadata, path, metrics, length):
+    """
+    labels and centroids of the clustering of the previous version in path
+    that causality was computed on (the one w/ representative metrics), 
+    from its cluster artifact. metrics new to this version are labeled -1, 
+    centroids are cut or zero padded to length. returns None, if there is 
+    no such artifact (e.g. for older measurements).
+    """
+    for srv in metadata["services"]:
+        if srv["name"] != service:
+            continue
+        for cluster in srv.get("clusters", {}).values():
+            if "rep_metrics" not in cluster or "artifact" not in cluster:
+                continue
+            previous = cluster_artifact.load(os.path.join(path, cluster["artifact"]))
+            positions = dict((c, i) for i, c in enumerate(previous.columns))
+            labels = np.array([previous.labels[positions[m]] if m in positions else -1
+                               for m in metrics])
+            centroids = np.zeros((previous.k, length))
+            n = min(length, previous.centroids.shape[1])
+            centroids[:, :n] = previous.centroids[:, :n]
+            return labels, centroids
+    return None
+
+def cluster_service(path, service, cluster_size, prev_metadata=None, n_init=1, seeding="random",
+                    minibatch_threshold=MINIBATCH_THRESHOLD, dtype=None, coarsen=1, max_shift=None,
+                    render=True):
+    name, cluster_sizes, filenames = cluster_service_sweep(path, service, [cluster_size],
+                                                           prev_metadata, n_init, seeding,
+                                                           minibatch_threshold, dtype, coarsen,
+                                                           max_shift)
+    if render:
+        for filename in filenames:
+            graphs.draw(filename)
+    if not cluster_sizes:
+        return (None, None)
+    return (name, cluster_sizes[0])
+
+def cluster_service_sweep(path, service, ks=range(2, 7), prev_metadata=None, n_init=1,
+                          seeding="random", minibatch_threshold=MINIBATCH_THRESHOLD, dtype=None,
+                          coarsen=1, max_shift=None, incremental=False, margin_threshold=0.05,
+                          prev_path=None, bisecting=False, silhouette="exact", two_level=None,
+                          partition_size=PARTITION_SIZE, partition_jobs=1,
+                          dedup_threshold=None, dataset=None, restart_jobs=1):
+    """
+    cluster a service for every cluster size in ks. the preprocessed data is
+    read, z-scored and transformed once, the pairwise distances for the 
+    silhouette score (unless silhouette is "simplified", see
+    write_clustering) are shared by all cluster sizes and the results are 
+    written to the metadata in a single update. the pairwise distances are
+    kept in the sbd_cache across runs. returns the service name, the
+    cluster sizes written and the cluster files to draw (see
+    graphs.RenderQueue). cluster sizes that were clustered already are
+    skipped or, if incremental is set and samples were appended since,
+    updated with do_incremental. if the cluster artifacts of the previous
+    version are found in prev_path, k-shape starts from its centroids. with
+    bisecting, all cluster sizes come from a single bisecting k-shape run
+    (unless there is an initial assigment). with two_level ("names" or
+    "sbd"), services of more than partition_size metrics are clustered with
+    two-level k-shape (see metric_partitions). with dedup_threshold, only
+    one metric of every group of duplicates (see dedup.duplicate_groups) is
+    clustered, the others join its cluster. dataset is the shared_dataset.Handle
+    of the preprocessed data, if it was parsed already.
+    """
     filename = os.path.join(path, service["preprocessed_filename"])
-    df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    if dataset is not None:
+        df = dataset.frame()
+    else:
+        df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
 
     initial_idx = None
+    initial_centroids = None
     if prev_metadata:
-        initial_idx = get_initial_clustering(service["name"], prev_metadata, df.columns)
-        # adjust cluster_size if an initial assigment has been found
+        initial = None
+        if prev_path is not None:
+            initial = get_initial_centroids(service["name"], prev_metadata, prev_path,
+                                            df.columns, len(df))
+        if initial is not None:
+            initial_idx, initial_centroids = initial
+            ks = [len(initial_centroids)]
+        else:
+            initial_idx = get_initial_clustering(service["name"], prev_metadata, df.columns)
+            # adjust cluster_size if an initial assigment has been found
+            if initial_idx is not None:
+                ks = [len(np.unique(initial_idx))]
+
+    matrix = zscore_matrix(df, dtype)
+    duplicates = None
+    if dedup_threshold is not None:
+        duplicates = dedup.Duplicates(df, matrix, dedup_threshold)
+        print("%s: %d of %d metrics are duplicates"
+              % (service["name"], len(duplicates), len(df.columns)))
+        df, matrix = duplicates.reduce()
         if initial_idx is not None:
-            cluster_size = len(np.unique(initial_idx))
-
-    prefix = "%s/%s-cluster-%d" % (path, service["name"], cluster_size)
-    if os.path.exists(prefix + "_1.png"):
-        print("skip " + prefix)
-        return (None, None)
+            initial_idx = initial_idx[duplicates.representatives]
+    distances_key = sbd_cache.key(filename, dtype, max_shift, dedup_threshold,
+                                  None if duplicates is None else df.columns)
+    cache = SpectralCache(matrix, dtype, max_shift, sbd_cache.load(path, distances_key))
+
+    partitions = None
+    if two_level is not None and len(df.columns) > partition_size:
+        partitions = metric_partitions(df, service["name"], matrix, two_level, partition_size,
+                                       dtype, max_shift)
+        print("%s: %d partitions by %s, sizes %s"
+              % (service["name"], len(partitions), two_level,
+                 sorted(len(rows) for rows in partitions)))
+
+    results = {}
+    cluster_files = []
+    bisected = None
+    for cluster_size in ks:
+        prefix = "%s/%s-cluster-%d" % (path, service["name"], cluster_size)
+        artifact = cluster_artifact.name(path, service["name"], cluster_size)
+        previous = None
+        if os.path.exists(artifact):
+            previous = cluster_artifact.load(artifact)
+            if not incremental or len(previous.time) >= len(df):
+                print("skip " + prefix)
+                continue
 
-    cluster_metrics, score, filenames = do_kshape(prefix, df, cluster_size, initial_idx)
-    if cluster_size < 2:
-        # no silhouette_score for cluster size 1
-        return (None, None)
-    print("silhouette_score: %f" % score)
+        if previous is not None:
+            cluster_metrics, scores, artifact = do_incremental(prefix, df, previous,
+                                                               margin_threshold, matrix, cache,
+                                                               silhouette, duplicates)
+        else:
+            if bisecting and initial_idx is None and bisected is None:
+                bisected, info = bisecting_kshape(matrix, max(ks), cache, n_init, dtype=dtype,
+                                                  return_info=True)
+                print("%s bisecting: %d splits, %.2fs, sbd %s"
+                      % (service["name"], len(bisected) - 1, info["time"],
+                         ", ".join("%f" % sbd for sbd in info["sbd"])))
+            if bisected is not None and cluster_size <= len(bisected):
+                cluster_metrics, scores, artifact = write_clustering(prefix, df, matrix,
+                                                                     bisected[cluster_size - 1],
+                                                                     cache, silhouette=silhouette,
+                                                                     duplicates=duplicates)
+            else:
+                if bisected is not None:
+                    print("%s: no split into %d clusters, falling back to k-shape"
+                          % (prefix, cluster_size))
+                cluster_metrics, scores, artifact = do_kshape(prefix, df, cluster_size,
+                                                              initial_idx, n_init, seeding,
+                                                              minibatch_threshold, dtype, coarsen,
+                                                              max_shift, matrix, cache,
+                                                              initial_centroids, silhouette,
+                                                              partitions, partition_jobs,
+                                                              duplicates, restart_jobs)
+        cluster_files.append(artifact)
+        if cluster_size < 2:
+            # no silhouette_score for cluster size 1
+            continue
+        for name, score in sorted(scores.items()):
+            print("%s: %f" % (name, score))
+        results[cluster_size] = dict(artifact=os.path.basename(artifact), metrics=cluster_metrics)
+        results[cluster_size].update(scores)
+    print("%s: spectral cache hits %d, misses %d" % (service["name"], cache.hits, cache.misses))
+
+    if not results:
+        return (service["name"], [], cluster_files)
+
+    # both metadata backends lock concurrent updates themselves
+    with metadata.update_service(path, service["name"]) as srv:
+        if "clusters" not in srv:
+            srv["clusters"] = {}
+        for cluster_size, d in results.items():
+            srv["clusters"][str(cluster_size)] = d
+        if duplicates is not None:
+            srv["duplicate_metrics"] = duplicates.columns()
+
+    # only after the results are recorded, the cache is best-effort
+    if cache.has_sbd:
+        sbd_cache.store(path, distances_key, cache.sbd_pdist())
+
+    return (service["name"], sorted(results), cluster_files)
+
+def task_cost(service, ks, silhouette="exact"):
+    """
+    estimated cost of cluster_service_sweep: every k-shape iteration
+    correlates n metrics of T samples with k centroids (n k T log T), the
+    exact silhouette score all n^2 pairs once. T is taken from
+    preprocessed_samples, if preprocess.py recorded it, otherwise it is
+    assumed equal for all services of a measurement.
+    """
+    n = len(service["preprocessed_fields"])
+    samples = service.get("preprocessed_samples", 1)
+    pairs = n if silhouette == "exact" else 0
+    return n * samples * math.log(max(samples, 2), 2) * (pairs + sum(ks))
+
+def previous_service_metadata(prev_metadata, service_name):
+    """
+    the part of prev_metadata that get_initial_clustering and
+    get_initial_centroids read for a service, so that a task does not carry
+    the metadata of all services
+    """
+    if prev_metadata is None:
+        return None
+    return dict(services=[srv for srv in prev_metadata["services"] if srv["name"] == service_name])
 
-    # protect the write access to the metadata file
-    metadata_lock.acquire()
-    with metadata.update(path) as data:
-        for srv in data["services"]:
-            if srv["name"] == service["name"]:
-                if "clusters" not in srv:
-                    srv["clusters"] = {}
-                d = dict(silhouette_score=score, filenames=filenames, metrics=cluster_metrics)
-                srv["clusters"][cluster_size] = d
-    metadata_lock.release()
+def _share(args):
+    return shared_dataset.share(*args)
 
-    return (service["name"], cluster_size)
+def _timed_sweep(task):
+    start = time.time()
+    res = cluster_service_sweep(*task)
+    return res, time.time() - start
 
 if __name__ == '__main__':
 
@@ -145,7 +468,106 @@ if __name__ == '__main__':
     parser.add_argument(
         "--initial-cluster-dir", 
          help = """dir w/ clustered data from which to derive initial cluster 
-                   assigments.""")
+                   assigments and centroids.""")
+
+    parser.add_argument(
+        "--n-init", type = int, default = 1,
+         help = """number of k-shape restarts per cluster size. the run w/ the 
+                   lowest total shape based distance is kept.""")
+
+    parser.add_argument(
+        "--restart-jobs", type = int, default = 1,
+         help = """number of threads per service that run the --n-init 
+                   restarts, -1 for one per cpu. default is 1.""")
+
+    parser.add_argument(
+        "--seeding", choices = ["random", "kshape++"], default = "random",
+         help = """initial assigment of the k-shape restarts.""")
+
+    parser.add_argument(
+        "--minibatch-threshold", type = int, default = MINIBATCH_THRESHOLD,
+         help = """use mini-batch k-shape for services w/ more than this 
+                   number of samples (metrics x time). default is %d.""" % MINIBATCH_THRESHOLD)
+
+    parser.add_argument(
+        "--dtype", choices = ["float64", "float32"], default = "float64",
+         help = """floating point precision used for clustering. float32
+                   halves the memory of the series and their spectra. see 
+                   precision_check.py to compare both on a measurement.""")
+
+    parser.add_argument(
+        "--coarsen", type = int, default = 1,
+         help = """cluster on averages of this many samples first (e.g. 10 for 
+                   5s at 500ms resolution), then refine on the full 
+                   resolution. default is 1 (no coarse stage).""")
+
+    parser.add_argument(
+        "--max-shift", type = int,
+         help = """only align metrics within +-max-shift samples (e.g. 10 for 
+                   5s at 500ms resolution). default is any shift.""")
+
+    parser.add_argument(
+        "--max-cluster-size", type = int, default = 6,
+         help = """cluster every service into 2 up to this many clusters. 
+                   default is 6.""")
+
+    parser.add_argument(
+        "--bisecting", action = "store_true",
+         help = """get all cluster sizes from a single bisecting k-shape run 
+                   per service, which splits the least cohesive cluster until 
+                   --max-cluster-size is reached.""")
+
+    parser.add_argument(
+        "--two-level", choices = ["names", "sbd"],
+         help = """cluster services w/ more than --partition-size metrics in 
+                   two levels: partition the metrics by name or by a coarse 
+                   k-shape run, cluster every partition and merge the 
+                   partition centroids into the final clusters.""")
+
+    parser.add_argument(
+        "--partition-size", type = int, default = PARTITION_SIZE,
+         help = """maximum number of metrics per partition w/ --two-level. 
+                   default is %d.""" % PARTITION_SIZE)
+
+    parser.add_argument(
+        "--partition-jobs", type = int, default = 1,
+         help = """number of threads per service that cluster the partitions 
+                   w/ --two-level, -1 for one per cpu. default is 1.""")
+
+    parser.add_argument(
+        "--dedup", action = "store_true",
+         help = """cluster only one of every group of (nearly) equal z-scored 
+                   metrics, the others are added to its cluster afterwards.""")
+
+    parser.add_argument(
+        "--dedup-threshold", type = float, default = dedup.THRESHOLD,
+         help = """w/ --dedup, maximum shape based distance (w/o shifting) of 
+                   duplicates. default is %s.""" % dedup.THRESHOLD)
+
+    parser.add_argument(
+        "--incremental", action = "store_true",
+         help = """update existing clusterings to samples appended to the 
+                   measurement instead of skipping them. only metrics close 
+                   to another cluster are reassigned.""")
+
+    parser.add_argument(
+        "--margin-threshold", type = float, default = 0.05,
+         help = """w/ --incremental, reassign metrics whose shape based 
+                   distance to the closest other centroid exceeds the one to 
+                   their own by less than this. default is 0.05.""")
+
+    parser.add_argument(
+        "--silhouette", choices = ["exact", "simplified"], default = "exact",
+         help = """score clusterings w/ the exact silhouette (all pairwise 
+                   distances) and the simplified one (distances to the 
+                   centroids), or only w/ the simplified one. see 
+                   silhouette_check.py to compare both on a measurement.""")
+
+    parser.add_argument(
+        "--render", choices = ["background", "deferred", "none"], default = "background",
+         help = """when to draw the cluster graphs: while clustering (in a few 
+                   extra processes), after clustering (w/ all cpus) or not at 
+                   all. graphs can be drawn later w/ graphs.py.""")
 
     args = parser.parse_args()
 
@@ -160,40 +582,77 @@ if __name__ == '__main__':
     else:
         prev_metadata = None
 
-    last_cluster_size = defaultdict(int)
-
     start_time = datetime.utcnow()
-    for n in range(2, 7):
 
-        # to reduce clustering time, use paralellism
-        pool = mp.Pool(mp.cpu_count())
+    # to reduce clustering time, use paralellism. services are the unit of 
+    # work: each task clusters one service for all cluster sizes.
+    pool = mp.Pool(mp.cpu_count())
+
+    # graphs are drawn in their own processes, not by the clustering tasks
+    render_queue = None
+    if args.render == "background":
+        render_queue = graphs.RenderQueue(max(1, mp.cpu_count() // 4))
+    elif args.render == "deferred":
+        render_queue = graphs.RenderQueue(mp.cpu_count(), deferred=True)
+
+    # the preprocessed data of every service is parsed once, tasks only get 
+    # a handle to it
+    services = metadata.load(args.msr_dir)["services"]
+    dataset = shared_dataset.SharedDataset()
+    # the shared copies live in memory (/dev/shm), remove them even if a 
+    # task fails
+    try:
+        handles = pool.map(_share, [(dataset.directory,
+                                     os.path.join(args.msr_dir, srv["preprocessed_filename"]))
+                                    for srv in services])
 
         # tasks to run in paralell
         tasks = []
-        for srv in metadata.load(args.msr_dir)["services"]:
-
-            if last_cluster_size[srv["name"]] > n:
-                continue
-
-            tasks.append((args.msr_dir, srv, n, prev_metadata))
-
-        if len(tasks) > 0:
-            jobs_remaining = len(tasks)
-            results = [pool.apply_async(cluster_service, t) for t in tasks]
-
-            for result in results:
-                jobs_remaining = jobs_remaining - 1
-                (service, cluster_size) = result.get()
-                if service is not None:
-                    last_cluster_size[service] = cluster_size
-                    print("finished pair (%s,%d). %d jobs remaining." 
-                        % (service, cluster_size, jobs_remaining))
+        for srv, handle in zip(services, handles):
+            tasks.append((args.msr_dir, srv, range(2, args.max_cluster_size + 1),
+                          previous_service_metadata(prev_metadata, srv["name"]), args.n_init, args.seeding,
+                          args.minibatch_threshold, np.dtype(args.dtype), args.coarsen,
+                          args.max_shift, args.incremental, args.margin_threshold,
+                          args.initial_cluster_dir, args.bisecting, args.silhouette,
+                          args.two_level, args.partition_size, args.partition_jobs,
+                          args.dedup_threshold if args.dedup else None, handle,
+                          args.restart_jobs))
+
+        # longest tasks first, so that a large service does not start last and 
+        # leave the other cpus idle. results are handled in completion order.
+        costs = dict((t[1]["name"], task_cost(t[1], t[2], args.silhouette)) for t in tasks)
+        tasks.sort(key=lambda t: costs[t[1]["name"]], reverse=True)
+
+        timings = defaultdict(list)
+        jobs_remaining = len(tasks)
+        for result, seconds in pool.imap_unordered(_timed_sweep, tasks):
+            jobs_remaining = jobs_remaining - 1
+            (service, cluster_sizes, cluster_files) = result
+            print("finished %s (cluster sizes %s) in %.1fs, estimated cost %.3g. %d jobs remaining." 
+                % (service, cluster_sizes, seconds, costs[service], jobs_remaining))
+            timings["name"].append(service)
+            timings["cost"].append(costs[service])
+            timings["seconds"].append(seconds)
+            if render_queue is not None:
+                render_queue.submit(cluster_files)
 
         # keep things tidy
         pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
         pool.join()
+        dataset.close()
+
+    # per-task wall time against the estimate, to calibrate task_cost
+    timings_file = os.path.join(args.msr_dir, "cluster-timings.tsv")
+    print(timings_file)
+    pd.DataFrame(timings).to_csv(timings_file, sep="\t", index=False)
 
-        print results
+    if render_queue is not None:
+        print("drawing graphs of %d clusterings" % len(render_queue.filenames))
+        render_queue.close()
 
     end_time = datetime.utcnow()
     sys.stdout.write(
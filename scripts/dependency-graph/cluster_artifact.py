@@ -0,0 +1,108 @@
+"""
+clustering result of a service for one cluster size, stored in a single
+uncompressed .npz file:
+
+ - time: the time base of all series (datetime64[ns])
+ - columns: the metric names
+ - series: the z-scored metrics (metrics x time)
+ - labels: the cluster of every metric
+ - centroids: the centroids (clusters x time)
+ - sbd: the shape based distance of every metric to its centroid
+ - shift: the shift that aligns every metric to its centroid (see
+   kshape.roll_zeropad)
+ - margin: how much closer every metric is to its centroid than to any
+   other (see kshape._margins)
+
+load() maps the file into memory once and returns views of the arrays, so
+no dates or numbers are parsed when reading the result.
+"""
+import os
+import struct
+import zipfile
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+def name(path, service_name, cluster_size):
+    return "%s/%s-cluster-%d.npz" % (path, service_name, cluster_size)
+
+def write(filename, time, columns, series, labels, centroids, sbd, shift, margin):
+    arrays = dict(time=np.asarray(time, dtype="datetime64[ns]"),
+                  columns=np.array([u"%s" % c for c in columns]),
+                  series=np.asarray(series),
+                  labels=np.asarray(labels, dtype=int),
+                  centroids=np.asarray(centroids),
+                  sbd=np.asarray(sbd),
+                  shift=np.asarray(shift, dtype=int),
+                  margin=np.asarray(margin, dtype=float))
+    f = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(filename) or ".",
+                                    suffix=".tmp")
+    try:
+        np.savez(f, **arrays)
+        f.close()
+        os.rename(f.name, filename)
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+def _map_npz(filename):
+    """
+    the arrays of an uncompressed .npz file as views of a single memory map
+    """
+    mm = np.memmap(filename, dtype=np.uint8, mode="r")
+    arrays = {}
+    with open(filename, "rb") as f:
+        z = zipfile.ZipFile(f)
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("%s: %s is compressed" % (filename, info.filename))
+            # skip the local file header, its name and extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[os.path.splitext(info.filename)[0]] = np.ndarray(
+                shape, dtype, buffer=mm, offset=f.tell(), order="F" if fortran_order else "C")
+    return arrays
+
+class ClusterArtifact(object):
+    def __init__(self, arrays):
+        self.time = pd.DatetimeIndex(arrays["time"], name="time")
+        self.columns = arrays["columns"]
+        self.series = arrays["series"]
+        self.labels = arrays["labels"]
+        self.centroids = arrays["centroids"]
+        self.sbd = arrays["sbd"]
+        self.shift = arrays["shift"]
+        # not recorded by older artifacts: every metric counts as unstable
+        self.margin = arrays.get("margin", np.zeros(len(self.labels)))
+
+    @property
+    def k(self):
+        return len(self.centroids)
+
+    def members(self, j):
+        """
+        rows of the metrics in cluster j
+        """
+        return np.flatnonzero(self.labels == j)
+
+    def frame(self, j, centroid=True):
+        """
+        the metrics of cluster j (and its centroid) as data frame, like the
+        cluster files written before
+        """
+        rows = self.members(j)
+        df = pd.DataFrame(self.series[rows].T, index=self.time,
+                          columns=[str(c) for c in self.columns[rows]])
+        if centroid:
+            df.insert(0, "centroid", self.centroids[j])
+        return df
+
+def load(filename):
+    return ClusterArtifact(_map_npz(filename))
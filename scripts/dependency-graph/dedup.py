@@ -0,0 +1,102 @@
+"""
+collapse (near) duplicate metrics of a service before clustering.
+
+many metrics are copies of each other once z-scored, e.g. byte and packet
+counters of the same interface. only one representative of every group of
+duplicates is clustered; the others are put back into the cluster of their
+representative when the result is written (see cluster.write_clustering).
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from kshape import _sbd_matrix
+
+# metrics are bucketed by the signs of TABLES random projections of BITS
+# each (their angle, see duplicate_groups); metrics sharing a bucket in any
+# table are duplicates if within THRESHOLD SBD (without shifting)
+TABLES = 8
+BITS = 12
+THRESHOLD = 0.01
+
+def duplicate_groups(matrix, threshold=THRESHOLD, tables=TABLES, bits=BITS, random_state=0):
+    """
+    groups of duplicate rows of matrix (the z-scored metrics), each led by
+    its first row, ordered by that row. rows without duplicates form groups
+    of their own.
+
+    rows are only compared by SBD if the signs of their projections onto
+    the same bits random directions agree in one of the tables. two rows at
+    an angle a differ in a sign with probability a / pi, so near duplicates
+    almost surely share a bucket (e.g. at SBD 0.01, a = 0.14, they miss all
+    8 tables of 12 bits with probability 0.1%), unrelated rows hardly ever.
+
+    >>> duplicate_groups(np.array([[-1, 0, 1], [1, 0, -1], [-1, 0.01, 1]]))
+    [[0, 2], [1]]
+    """
+    matrix = np.asarray(matrix)
+    directions = np.random.RandomState(random_state).randn(matrix.shape[1], tables * bits)
+    signs = np.dot(matrix, directions) > 0
+    buckets = defaultdict(list)
+    for i, row in enumerate(signs):
+        for t in range(tables):
+            buckets[(t, row[t * bits:(t + 1) * bits].tobytes())].append(i)
+    mates = defaultdict(set)
+    for rows in buckets.values():
+        for i in rows:
+            mates[i].update(rows)
+
+    grouped = np.zeros(len(matrix), dtype=bool)
+    groups = []
+    for first in range(len(matrix)):
+        if grouped[first]:
+            continue
+        grouped[first] = True
+        group = [first]
+        rest = np.array(sorted(i for i in mates[first] if not grouped[i]), dtype=int)
+        if len(rest):
+            sbd = _sbd_matrix(matrix[first:first + 1], matrix[rest], max_shift=0)[0][0]
+            # constant series have no shape, but equal ones are duplicates
+            same = (sbd <= threshold) | (matrix[rest] == matrix[first]).all(axis=1)
+            group += [int(i) for i in rest[same]]
+            grouped[rest[same]] = True
+        groups.append(group)
+    return groups
+
+class Duplicates(object):
+    """
+    the duplicate groups of the metrics of df (a service), z-scored in
+    matrix
+    """
+    def __init__(self, df, matrix, threshold=THRESHOLD):
+        self.df = df
+        self.matrix = matrix
+        self.groups = duplicate_groups(matrix, threshold)
+        self.representatives = [group[0] for group in self.groups]
+        # the group of every row of matrix
+        self.rows = np.zeros(len(matrix), dtype=int)
+        for i, group in enumerate(self.groups):
+            self.rows[group] = i
+
+    def __len__(self):
+        return len(self.matrix) - len(self.groups)
+
+    def reduce(self):
+        """
+        df and matrix restricted to the representatives
+        """
+        return self.df[self.df.columns[self.representatives]], self.matrix[self.representatives]
+
+    def expand(self, a):
+        """
+        per representative values of a for all metrics
+        """
+        return np.asarray(a)[self.rows]
+
+    def columns(self):
+        """
+        names of the duplicates of every representative with duplicates
+        """
+        columns = self.df.columns
+        return dict((columns[group[0]], [columns[i] for i in group[1:]])
+                    for group in self.groups if len(group) > 1)
@@ -16,38 +16,58 @@ DEFAULT_CALLGRAPH_FILE_PATH = "openstack-callgraph.dot"
 
 # custom modules
 import metadata
+import cluster_artifact
 from kshape import zscore, _sbd
 from preprocess import interpolate_missing
 
 APP_METRIC_DELIMITER = "|"
 
-def preferred_cluster(clusters):
+def preferred_cluster(clusters, score="silhouette_score"):
+    """
+    cluster size with the best score. clusterings scored without the exact
+    silhouette (cluster.py --silhouette simplified) are compared by their
+    simplified silhouette.
+    """
+    if not all(score in v for v in clusters.values()):
+        score = "simplified_silhouette_score"
     preferred = 0
     preferred_value = -1
     for k, v in clusters.items():
-        if v["silhouette_score"] > preferred_value:
+        if v[score] > preferred_value:
             preferred = int(k)
-            preferred_value = v["silhouette_score"]
+            preferred_value = v[score]
     return preferred
 
-def best_column_of_cluster(service, filenames, path, prev_cluster_metadata=None):
+def cluster_members(cluster, path):
+    """
+    the metrics of every cluster as data frame and their distances to the
+    centroid, from the cluster artifact or, for older measurements, from the
+    cluster files
+    """
+    if "artifact" in cluster:
+        artifact = cluster_artifact.load(os.path.join(path, cluster["artifact"]))
+        for j in range(artifact.k):
+            yield artifact.frame(j, centroid=False), artifact.sbd[artifact.members(j)]
+        return
+    for filename in cluster["filenames"]:
+        cluster_path = os.path.join(path, filename)
+        df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
+        members = df.drop("centroid", axis=1)
+        yield members, [_sbd(df.centroid, members[c])[0] for c in members.columns]
+
+def best_column_of_cluster(service, cluster, path, prev_cluster_metadata=None):
     selected_columns = {}
     index = None
     # representative metrics, per cluster index
     rep_metrics = dict()
 
-    for i, filename in enumerate(filenames):
+    for i, (df, distances) in enumerate(cluster_members(cluster, path)):
 
         best_distance = np.inf
         best_column = None
 
-        cluster_path = os.path.join(path, filename)
-        df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
         # pick the rep, metric as the one w/ shortest distance to the 'centroid'
-        for c in df.columns:
-            if c == "centroid":
-                continue
-            distance = _sbd(df.centroid, df[c])[0]
+        for c, distance in zip(df.columns, distances):
             if distance < best_distance:
                 best_distance = distance
                 best_column = c
@@ -85,20 +105,16 @@ def read_service(srv, path, prev_cluster_metadata):
             df[c] = zscore(df[c])
     else:
         cluster = srv["clusters"][str(preferred)]
-        rep_metrics, df = best_column_of_cluster(srv["name"], cluster["filenames"], path, prev_cluster_metadata)
+        rep_metrics, df = best_column_of_cluster(srv["name"], cluster, path, prev_cluster_metadata)
 
     # write additional metadata about components:
     #   - the preferred cluster for the component (is it really necessary?)
     #   - the representative metrics for each cluster
-    with metadata.update(path) as data:
-        for _service in data["services"]:
-            if _service["name"] == srv["name"]:
-                if "pref_cluster" not in _service:
-                    _service["pref_cluster"] = preferred
-                if preferred == 0:
-                    continue
-                if "rep_metrics" not in _service["clusters"][str(preferred)]:
-                    _service["clusters"][str(preferred)]["rep_metrics"] = rep_metrics
+    with metadata.update_service(path, srv["name"]) as _service:
+        if "pref_cluster" not in _service:
+            _service["pref_cluster"] = preferred
+        if preferred != 0 and "rep_metrics" not in _service["clusters"][str(preferred)]:
+            _service["clusters"][str(preferred)]["rep_metrics"] = rep_metrics
 
     new_names = []
     for column in df.columns:
@@ -1,11 +1,13 @@
 import os
 import sys
+import multiprocessing as mp
 
 from plot import plt, sns
 
 from cycler import cycler
 import pandas as pd
 from kshape import _sbd, lag
+import cluster_artifact
 
 COLORS = [
   "#000000", "#FFFF00", "#1CE6FF", "#FF34FF", "#FF4A46", "#008941", "#006FA6", "#A30059",
@@ -73,17 +75,22 @@ def draw_sbd_bar_plot(distances, ax):
     ax.set_xticks([])
     ax.set_xlabel("metrics")
 
-def draw_lag(df, ax):
-    lags = []
-    for c in df.columns[1:]:
-        lags.append(lag(df.centroid, df[c]))
+def draw_lag(df, ax, lags=None):
+    if lags is None:
+        lags = []
+        for c in df.columns[1:]:
+            lags.append(lag(df.centroid, df[c]))
     ax.set_ylabel("lag towards centroid")
     ax.bar(range(len(df.columns) - 1), lags, align='center', color=COLORS[1:])
     ax.set_xlabel("lag [500ms]")
     ax.set_xticks([])
     ax.set_xlabel("metrics")
 
-def write(df, name):
+def write(df, name, distances=None, lags=None):
+    """
+    distances and lags of the metrics towards the centroid are computed
+    from df, if not given
+    """
     fig, axes = plt.subplots(ncols=2, nrows=3, figsize=(20,10))
     draw_series_combined(df, name, axes[0, 0])
     axes[0,1].axis('off')
@@ -92,30 +99,95 @@ def write(df, name):
     draw_series_seperate(df, axes[2, 0])
 
     if df.centroid.notnull().any() and df.centroid.var() != 0:
-        distances = []
-        for c in df.columns[1:]:
-            distances.append(_sbd(df.centroid, df[c])[0])
+        if distances is None:
+            distances = []
+            for c in df.columns[1:]:
+                distances.append(_sbd(df.centroid, df[c])[0])
 
-        draw_lag(df, axes[2,1])
+        draw_lag(df, axes[2,1], lags)
         draw_sbd_bar_plot(distances, axes[1,0])
         draw_sbd_dist_plot(distances, axes[1,1])
     try:
         plt.tight_layout()
         plt.savefig(name, dpi=200)
-        plt.close("all")
     except Exception as e:
-        import pdb; pdb.set_trace()
         print("graph %s failed %s" % (name, e))
+    finally:
+        plt.close("all")
+
+def png_name(name):
+    for ext in [".gz", ".tsv"]:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name + ".png"
 
 def draw_graph(name):
     df = pd.read_csv(name, sep="\t", index_col='time', parse_dates=True)
-    write(df, os.path.splitext(name)[0] + ".png")
+    png = png_name(name)
+    write(df, png)
+    return png
+
+def draw_artifact(name):
+    """
+    one graph per cluster of a cluster_artifact, named like the graphs of
+    the cluster files (<service>-cluster-<k>_<cluster>.png)
+    """
+    artifact = cluster_artifact.load(name)
+    prefix = os.path.splitext(name)[0]
+    pngs = []
+    for j in range(artifact.k):
+        png = "%s_%d.png" % (prefix, j + 1)
+        rows = artifact.members(j)
+        write(artifact.frame(j), png, artifact.sbd[rows], -artifact.shift[rows])
+        pngs.append(png)
+    return pngs
+
+def draw(name):
+    if name.endswith(".npz"):
+        return draw_artifact(name)
+    return [draw_graph(name)]
+
+class RenderQueue(object):
+    """
+    draws cluster artifacts or files (see draw) in a pool of processes, so
+    that rendering stays off the clustering path. if deferred, nothing is
+    drawn before close(), which waits for all graphs and returns their
+    names.
+    """
+    def __init__(self, processes=None, deferred=False):
+        self.processes = processes
+        self.deferred = deferred
+        self.pool = None
+        self.filenames = []
+        self.results = []
+
+    def submit(self, filenames):
+        self.filenames.extend(filenames)
+        if not self.deferred:
+            self._draw(filenames)
+
+    def _draw(self, filenames):
+        if self.pool is None:
+            self.pool = mp.Pool(self.processes)
+        for name in filenames:
+            self.results.append(self.pool.apply_async(draw, (name,)))
+
+    def close(self):
+        if self.deferred:
+            self._draw(self.filenames)
+        pngs = []
+        for r in self.results:
+            pngs.extend(r.get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        return pngs
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         sys.stderr.write("USAGE: %s centroid\n" % sys.argv[0])
         sys.exit(1)
     for name in sys.argv[1:]:
-        draw_graph(name)
+        draw(name)
         print(name)
     #docker_usage(path)
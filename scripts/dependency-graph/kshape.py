@@ -1,14 +1,28 @@
 import math
+import time
 import numpy as np
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
-from numpy.random import randint, seed
+from numpy.random import seed
 from numpy.linalg import norm, eigh
-from numpy.linalg import norm
-from numpy.fft import fft, ifft
+try:
+    # keeps single precision input in single precision
+    from scipy.fft import rfft, irfft
+except ImportError:
+    from numpy.fft import rfft, irfft
 
+# upper bound for the cross-correlation block materialized at once by
+# _ncc_c_matrix (in bytes)
+NCC_BATCH_BYTES = 1 << 26
+# bands of shifts up to this width are correlated directly instead of via FFT
+DIRECT_NCC_MAX_SHIFT = 32
+# rows per block of the upper triangle computed by _sbd_pdist
+PDIST_BLOCK_ROWS = 256
 
-def zscore(a, axis=0, ddof=0):
-    a = np.asanyarray(a)
+
+def zscore(a, axis=0, ddof=0, dtype=None):
+    a = np.asanyarray(a, dtype=dtype)
     mns = a.mean(axis=axis)
     sstd = a.std(axis=axis, ddof=ddof)
     if axis and mns.ndim < a.ndim:
@@ -19,6 +33,16 @@ def zscore(a, axis=0, ddof=0):
     return np.nan_to_num(res)
 
 
+def _as_float(a, dtype=None):
+    """
+    a as floating point array of the given dtype, or of its own dtype if it
+    is a floating point array already
+    """
+    a = np.asarray(a)
+    if dtype is None:
+        dtype = a.dtype if a.dtype.kind == 'f' else float
+    return a.astype(dtype, copy=False)
+
 def roll_zeropad(a, shift, axis=None):
     a = np.asanyarray(a)
     if shift == 0: return a
@@ -42,8 +66,11 @@ def roll_zeropad(a, shift, axis=None):
     else:
         return res
 
-def _ncc_c(x, y):
+def _ncc_c(x, y, dtype=None, max_shift=None):
     """
+    Normalized cross-correlation of x and y for all shifts, or only for the
+    2 * max_shift + 1 shifts within +-max_shift.
+
     >>> _ncc_c([1,2,3,4], [1,2,3,4])
     array([ 0.13333333,  0.36666667,  0.66666667,  1.        ,  0.66666667,
             0.36666667,  0.13333333])
@@ -51,20 +78,307 @@ def _ncc_c(x, y):
     array([ 0.33333333,  0.66666667,  1.        ,  0.66666667,  0.33333333])
     >>> _ncc_c([1,2,3], [-1,-1,-1])
     array([-0.15430335, -0.46291005, -0.9258201 , -0.77151675, -0.46291005])
+    >>> _ncc_c([1,2,3], [-1,-1,-1], dtype=np.float32).dtype
+    dtype('float32')
+    >>> _ncc_c([1,2,3,4], [1,2,3,4], max_shift=1)
+    array([ 0.66666667,  1.        ,  0.66666667])
     """
+    x = _as_float(x, dtype)
+    y = _as_float(y, dtype)
     den = np.array(norm(x) * norm(y))
     den[den == 0] = np.Inf
 
     x_len = len(x)
-    fft_size = 1<<(2*x_len-1).bit_length()
-    cc = ifft(fft(x, fft_size) * np.conj(fft(y, fft_size)))
+    if max_shift is not None and max_shift <= DIRECT_NCC_MAX_SHIFT:
+        w = min(max_shift, x_len - 1)
+        cc = np.array([np.dot(*_lagged(x, y, lag)) for lag in range(-w, w + 1)], dtype=x.dtype)
+        return cc / den
+    fft_size = _fft_size(x_len)
+    cc = irfft(_rfft(x, fft_size) * np.conj(_rfft(y, fft_size)), fft_size)
+    cc = cc.astype(x.dtype, copy=False)
     cc = np.concatenate((cc[-(x_len-1):], cc[:x_len]))
-    return np.real(cc) / den
+    if max_shift is not None and max_shift < x_len - 1:
+        cc = cc[x_len-1-max_shift:x_len+max_shift]
+    return cc / den
 
-def lag(x, y):
-    return ((_ncc_c(x, y).argmax() + 1) - max(len(x), len(y))) * -1
+def _lagged(x, y, lag):
+    """
+    the overlapping parts of x and y (along the last axis), if x is shifted
+    by lag towards the start
+    """
+    length = x.shape[-1]
+    if lag >= 0:
+        return x[..., lag:], y[..., :length-lag]
+    return x[..., :length+lag], y[..., -lag:]
 
-def _sbd(x, y):
+def _ncc_c_band(x, y, max_shift):
+    """
+    Maximum of the normalized cross-correlation and its shift like
+    _ncc_c_spectra, but only over shifts within +-max_shift and computed
+    directly in O(n * k * T * max_shift) instead of via FFT.
+
+    >>> _ncc_c_band(np.array([[1.,2,3,4], [0,1,2,3]]), np.array([[1.,2,3,4], [4,3,2,1]]), 1)
+    (array([[ 1.        ,  0.83333333],
+           [ 0.97590007,  0.78072006]]), array([[0, 1],
+           [0, 1]]))
+    """
+    w = min(max_shift, x.shape[1] - 1)
+    den = np.outer(norm(x, axis=1), norm(y, axis=1))
+    den[den == 0] = np.inf
+
+    ncc = np.empty(den.shape, dtype=den.dtype)
+    ncc.fill(-np.inf)
+    idx = np.zeros(den.shape, dtype=int)
+    for i, lag in enumerate(range(-w, w + 1)):
+        x_part, y_part = _lagged(x, y, lag)
+        cc = np.dot(x_part, y_part.T) / den
+        # strictly greater keeps the first maximum, like argmax
+        better = cc > ncc
+        ncc[better] = cc[better]
+        idx[better] = i
+    return ncc, idx - w
+
+def _fft_size(length):
+    return 1<<(2*length-1).bit_length()
+
+def _rfft(a, n, axis=-1):
+    """
+    rfft of a, kept in single precision for float32 input also when the
+    numpy.fft fallback computes it in double precision.
+
+    >>> _rfft(np.array([1, 2], dtype=np.float32), 4).dtype
+    dtype('complex64')
+    """
+    spectra = rfft(a, n, axis=axis)
+    if a.dtype == np.float32:
+        return spectra.astype(np.complex64, copy=False)
+    return spectra
+
+def _ncc_c_spectra(x_fft, x_norm, y_fft, y_norm, x_len, max_shift=None):
+    """
+    _ncc_c_matrix on precomputed (rfft, norm) pairs of both matrices
+    """
+    w = x_len - 1
+    if max_shift is not None:
+        w = min(max_shift, w)
+    fft_size = _fft_size(x_len)
+    y_fft = np.conj(y_fft)
+
+    den = np.outer(x_norm, y_norm)
+    den[den == 0] = np.inf
+
+    ncc = np.empty(den.shape, dtype=den.dtype)
+    idx = np.empty(den.shape, dtype=int)
+    # one (rows x k x fft_size) block per step to bound memory usage
+    step = max(1, NCC_BATCH_BYTES // (den.itemsize * fft_size * len(y_norm)))
+    for start in range(0, len(x_norm), step):
+        end = start + step
+        cc = irfft(x_fft[start:end, None, :] * y_fft[None, :, :], fft_size, axis=2)
+        cc = np.concatenate((cc[..., -(x_len-1):], cc[..., :x_len]), axis=2)
+        cc = cc[..., x_len-1-w:x_len+w]
+        cc /= den[start:end, :, None]
+        idx[start:end] = cc.argmax(axis=2)
+        ncc[start:end] = cc.max(axis=2)
+    return ncc, idx - w
+
+def _ncc_c_matrix(x, y=None, dtype=None, max_shift=None):
+    """
+    Maximum of the normalized cross-correlation for every row of x against
+    every row of y (x against itself if y is None). Returns the maxima and the
+    shifts at which they occur as (n x k) matrices. With max_shift, only
+    shifts within +-max_shift are considered.
+
+    >>> ncc, shift = _ncc_c_matrix([[1,2,3,4], [0,1,2,3]], [[1,2,3,4], [4,3,2,1]])
+    >>> ncc
+    array([[ 1.        ,  0.83333333],
+           [ 0.97590007,  0.82951506]])
+    >>> shift
+    array([[0, 1],
+           [0, 2]])
+    """
+    cache = SpectralCache(x, dtype, max_shift)
+    if y is None:
+        return cache.ncc_c_series()
+    return cache.ncc_c(y)
+
+class SpectralCache(object):
+    """
+    Spectra of the input series of a clustering run. The series are
+    transformed once and reused for every iteration and every k of a sweep;
+    centroid spectra are only recomputed for centroids that changed.
+
+    With a max_shift up to DIRECT_NCC_MAX_SHIFT, cross-correlations are
+    computed directly on the series instead and no spectra are kept. sbd
+    are the condensed pairwise distances returned by sbd_pdist, if they
+    are known already (e.g. from sbd_cache); they are ignored if their
+    number does not match the series.
+
+    >>> cache = SpectralCache([[1,2,3,4], [0,1,2,3]])
+    >>> cache.fft_size
+    8
+    >>> _ = cache.series(); _ = cache.series()
+    >>> _ = cache.centroids(np.array([[1,2,3,4], [0,0,0,0]]))
+    >>> _ = cache.centroids(np.array([[1,2,3,4], [1,1,1,1]]))
+    >>> cache.hits, cache.misses
+    (3, 5)
+    >>> SpectralCache([[1,2,3,4], [0,1,2,3]], sbd=np.zeros(3)).has_sbd
+    False
+    """
+    def __init__(self, x, dtype=None, max_shift=None, sbd=None):
+        self.x = np.atleast_2d(_as_float(x, dtype))
+        self.length = self.x.shape[1]
+        self.fft_size = _fft_size(self.length)
+        self.max_shift = max_shift
+        self.direct = max_shift is not None and max_shift <= DIRECT_NCC_MAX_SHIFT
+        self.hits = 0
+        self.misses = 0
+        self._series = None
+        self._centroids = None
+        self._centroids_fft = None
+        self._centroids_norm = None
+        n = len(self.x)
+        self._sbd = sbd if sbd is not None and len(sbd) == n * (n - 1) // 2 else None
+
+    def transform(self, y):
+        y = np.atleast_2d(_as_float(y, self.x.dtype))
+        return _rfft(y, self.fft_size, axis=1), norm(y, axis=1)
+
+    def series(self):
+        if self._series is None:
+            self.misses += len(self.x)
+            self._series = self.transform(self.x)
+        else:
+            self.hits += len(self.x)
+        return self._series
+
+    def centroids(self, centroids):
+        centroids = np.atleast_2d(centroids)
+        if self.direct:
+            self._centroids = _as_float(centroids, self.x.dtype)
+            return None
+        if self._centroids is None or self._centroids.shape != centroids.shape:
+            self.misses += len(centroids)
+            self._centroids = _as_float(centroids, self.x.dtype).copy()
+            self._centroids_fft, self._centroids_norm = self.transform(centroids)
+            return self._centroids_fft, self._centroids_norm
+        for j, centroid in enumerate(centroids):
+            if np.array_equal(self._centroids[j], centroid):
+                self.hits += 1
+                continue
+            self.misses += 1
+            self._centroids[j] = centroid
+            self._centroids_fft[j] = _rfft(self._centroids[j], self.fft_size)
+            self._centroids_norm[j] = norm(centroid)
+        return self._centroids_fft, self._centroids_norm
+
+    def ncc_c(self, centroids, rows=None):
+        """
+        _ncc_c_matrix of the input series (only rows, if given) against
+        centroids
+        """
+        if rows is None:
+            rows = slice(None)
+        c_spectra = self.centroids(centroids)
+        if self.direct:
+            return _ncc_c_band(self.x[rows], self._centroids, self.max_shift)
+        x_fft, x_norm = self.series()
+        c_fft, c_norm = c_spectra
+        return _ncc_c_spectra(x_fft[rows], x_norm[rows], c_fft, c_norm, self.length,
+                              self.max_shift)
+
+    def ncc_c_to(self, rows, j):
+        """
+        NCC maxima of the input series rows against centroid j of the last
+        centroids passed to ncc_c or centroids
+        """
+        if self.direct:
+            return _ncc_c_band(self.x[rows], self._centroids[j:j+1], self.max_shift)[0][:, 0]
+        x_fft, x_norm = self._series
+        return _ncc_c_spectra(x_fft[rows], x_norm[rows], self._centroids_fft[j:j+1],
+                              self._centroids_norm[j:j+1], self.length, self.max_shift)[0][:, 0]
+
+    def ncc_c_series(self, cols=None):
+        """
+        _ncc_c_matrix of the input series against the input series cols (all
+        if None)
+        """
+        if cols is None:
+            cols = slice(None)
+        if self.direct:
+            return _ncc_c_band(self.x, self.x[cols], self.max_shift)
+        x_fft, x_norm = self.series()
+        return _ncc_c_spectra(x_fft, x_norm, x_fft[cols], x_norm[cols], self.length,
+                              self.max_shift)
+
+    def sbd_pdist(self):
+        """
+        Condensed pairwise SBD of the series (see _sbd_pdist), computed once
+        per cache.
+        """
+        if self._sbd is None:
+            n = len(self.x)
+            self._sbd = np.empty(n * (n - 1) // 2, dtype=self.x.dtype)
+            pos = 0
+            for start in range(0, n - 1, PDIST_BLOCK_ROWS):
+                end = min(start + PDIST_BLOCK_ROWS, n - 1)
+                # rows start:end against the columns right of the diagonal
+                if self.direct:
+                    ncc = _ncc_c_band(self.x[start:end], self.x[start:], self.max_shift)[0]
+                else:
+                    x_fft, x_norm = self.series()
+                    ncc = _ncc_c_spectra(x_fft[start:end], x_norm[start:end], x_fft[start:],
+                                         x_norm[start:], self.length, self.max_shift)[0]
+                for i in range(end - start):
+                    row = ncc[i, i + 1:]
+                    self._sbd[pos:pos + len(row)] = 1 - row
+                    pos += len(row)
+            # rounding can push the distance of equal shapes below zero
+            np.clip(self._sbd, 0, None, out=self._sbd)
+        return self._sbd
+
+    @property
+    def has_sbd(self):
+        """
+        Whether the pairwise SBD were given or computed already.
+        """
+        return self._sbd is not None
+
+    def sbd_matrix(self):
+        """
+        Pairwise SBD of the series as square matrix, e.g. for sklearn's
+        metric='precomputed'.
+        """
+        return _squareform(self.sbd_pdist(), len(self.x))
+
+    def share(self):
+        """
+        A cache on the same series that reuses their spectra, but keeps its
+        own centroid spectra and counters (e.g. for concurrent restarts).
+        """
+        cache = SpectralCache(self.x, max_shift=self.max_shift)
+        if not self.direct:
+            cache._series = self.series()
+        return cache
+
+    def subset(self, rows):
+        """
+        A cache on the series rows that reuses their spectra.
+        """
+        cache = SpectralCache(self.x[rows], max_shift=self.max_shift)
+        if not self.direct:
+            x_fft, x_norm = self.series()
+            cache._series = x_fft[rows], x_norm[rows]
+        return cache
+
+def _shift(ncc, x, y, max_shift):
+    if max_shift is None:
+        return (ncc.argmax() + 1) - max(len(x), len(y))
+    return ncc.argmax() - (len(ncc) - 1) // 2
+
+def lag(x, y, max_shift=None):
+    return _shift(_ncc_c(x, y, max_shift=max_shift), x, y, max_shift) * -1
+
+def _sbd(x, y, dtype=None, max_shift=None):
     """
     >>> _sbd([1,1,1], [1,1,1])
     (-2.2204460492503131e-16, array([1, 1, 1]))
@@ -72,16 +386,113 @@ def _sbd(x, y):
     (0.043817112532485103, array([1, 2, 3]))
     >>> _sbd([1,2,3], [0,1,2])
     (0.043817112532485103, array([0, 1, 2]))
+    >>> dist, yshift = _sbd([0,0,1,2,0,0], [1,2,0,0,0,0], max_shift=1)
+    >>> print(round(dist, 8))
+    0.6
+    >>> yshift
+    array([0, 1, 2, 0, 0, 0])
     """
-    ncc = _ncc_c(x, y)
-    idx = ncc.argmax()
-    dist = 1 - ncc[idx]
-    yshift = roll_zeropad(y, (idx + 1) - max(len(x), len(y)))
+    ncc = _ncc_c(x, y, dtype, max_shift)
+    dist = 1 - ncc.max()
+    if dtype is not None:
+        y = np.asarray(y, dtype=dtype)
+    yshift = roll_zeropad(y, _shift(ncc, x, y, max_shift))
 
     return dist, yshift
 
+def _sbd_matrix(x, y=None, dtype=None, max_shift=None):
+    """
+    Shape based distance between all rows of x and all rows of y (or all
+    pairs of rows of x, if y is None). Returns the distance matrix and the
+    shift to apply to y[j] with roll_zeropad to align it to x[i].
+
+    >>> dist, shift = _sbd_matrix([[1,2,3,4], [1,2,2,1]])
+    >>> dist.round(8)
+    array([[ 0.        ,  0.07623957],
+           [ 0.07623957,  0.        ]])
+    >>> shift
+    array([[ 0,  1],
+           [-1,  0]])
+    >>> _sbd_matrix([[1,2,3,4], [1,2,2,1]], dtype=np.float32)[0].dtype
+    dtype('float32')
+    """
+    ncc, shift = _ncc_c_matrix(x, y, dtype, max_shift)
+    return 1 - ncc, shift
+
+def _sbd_pdist(x, dtype=None, max_shift=None):
+    """
+    Shape based distance between all pairs of rows of x as condensed vector
+    in the order of scipy's pdist: d(0, 1), d(0, 2), ..., d(n - 2, n - 1).
+    Only the upper triangle is computed and no shifts are applied; the
+    result has the dtype of the computation (e.g. np.float32).
+
+    >>> d = _sbd_pdist([[1,2,3,4], [1,2,2,1], [2,4,6,8]])
+    >>> d.round(8)
+    array([ 0.07623957,  0.        ,  0.07623957])
+    >>> _squareform(d, 3).round(8)
+    array([[ 0.        ,  0.07623957,  0.        ],
+           [ 0.07623957,  0.        ,  0.07623957],
+           [ 0.        ,  0.07623957,  0.        ]])
+    """
+    return SpectralCache(x, dtype, max_shift).sbd_pdist()
+
+def _squareform(d, n):
+    """
+    square symmetric matrix with zero diagonal from the condensed vector d
+    of n rows
+    """
+    res = np.zeros((n, n), dtype=d.dtype)
+    i, j = np.triu_indices(n, 1)
+    res[i, j] = d
+    res[j, i] = d
+    return res
+
+def _align(x, center, dtype=None, max_shift=None):
+    """
+    Every row of x shifted (with zero padding) to its best alignment with
+    center, as _sbd(center, x[i])[1] does for a single row. The shifts are
+    found in one NCC batch and applied with a single gather.
+
+    >>> _align(np.array([[0,1,2,0], [2,0,0,1]]), np.array([1,2,0,0]))
+    array([[ 1.,  2.,  0.,  0.],
+           [ 0.,  2.,  0.,  0.]])
+    """
+    x = np.atleast_2d(_as_float(x, dtype))
+    n, length = x.shape
+    # shifts to align center to the rows; the rows move the other way
+    _, shift = _ncc_c_matrix(x, center[None, :], dtype, max_shift)
+    src = np.arange(length)[None, :] + shift
+    outside = (src < 0) | (src >= length)
+    src += np.arange(0, n * length, length)[:, None]
+    res = np.empty_like(x)
+    np.take(x, src, out=res, mode='clip')
+    res[outside] = 0
+    return res
+
+
+def _top_eigenvector(y):
+    """
+    Top eigenvector of P * (y^T y) * P, where P is the centering matrix
+    I - 1/T. Instead of forming these T x T matrices, the rows of y are
+    centered directly and the eigenproblem is solved on the smaller of the
+    (members x members) Gram matrix and the (T x T) scatter matrix.
+
+    >>> _top_eigenvector(np.array([[1.,2.,3.], [2.,4.,6.]]))
+    array([-0.70710678,  0.        ,  0.70710678])
+    """
+    y = y - y.mean(axis=1)[:, None]
+    if y.shape[0] >= y.shape[1]:
+        _, vec = eigh(np.dot(y.T, y))
+        return vec[:,-1]
+    _, vec = eigh(np.dot(y, y.T))
+    # right singular vector from the left one: v = y^T u / |y^T u|
+    centroid = np.dot(y.T, vec[:,-1])
+    length = norm(centroid)
+    if length == 0:
+        return centroid
+    return centroid / length
 
-def _extract_shape(idx, x, j, cur_center):
+def _extract_shape(idx, x, j, cur_center, dtype=None, max_shift=None):
     """
     >>> _extract_shape(np.array([0,1,2]), np.array([[1,2,3], [4,5,6]]), 1, np.array([0,3,4]))
     array([-1.,  0.,  1.])
@@ -92,76 +503,217 @@ def _extract_shape(idx, x, j, cur_center):
     >>> _extract_shape(np.array([0,0,1,0]), np.array([[1,2,3,4],[0,1,2,3],[-1,1,-1,1],[1,2,2,3]]), 0, np.array([-1.2089303,-0.19618238,0.19618238,1.2089303]))
     array([-1.19623139, -0.26273649,  0.26273649,  1.19623139])
     """
-    _a = []
-    for i in range(len(idx)):
-        if idx[i] == j:
-            if cur_center.sum() == 0:
-                opt_x = x[i]
-            else:
-                _, opt_x = _sbd(cur_center, x[i])
-            _a.append(opt_x)
-    a = np.array(_a)
+    a = _as_float(x[np.flatnonzero(idx == j)], dtype)
+    if len(a) and cur_center.sum() != 0:
+        a = _align(a, cur_center, dtype, max_shift)
 
     if len(a) == 0:
-        return np.zeros((1, x.shape[1]))
-    columns = a.shape[1]
+        return np.zeros((1, x.shape[1]), dtype=dtype)
     y = zscore(a,axis=1,ddof=1)
-    s = np.dot(y.transpose(), y)
-
-    p = np.empty((columns, columns))
-    p.fill(1.0/columns)
-    p = np.eye(columns) - p
-
-    # these are the 2 most expensive operations
-    m = np.dot(np.dot(p, s), p)
-    _, vec = eigh(m)
-    centroid = vec[:,-1]
+    centroid = _top_eigenvector(y)
     finddistance1 = math.sqrt(((a[0] - centroid) ** 2).sum())
     finddistance2 = math.sqrt(((a[0] + centroid) ** 2).sum())
 
     if finddistance1 >= finddistance2:
         centroid *= -1
 
-    return zscore(centroid, ddof=1)
+    return zscore(centroid, ddof=1, dtype=dtype)
+
+def _random_state(random_state):
+    """
+    None uses numpy's global random state, integers seed a new one
+    """
+    if random_state is None:
+        return np.random.mtrand._rand
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+def _kshape_plusplus(x, k, cache, random_state):
+    """
+    k-means++ seeding in SBD space: the first seed is picked uniformly, every
+    further seed with a probability proportional to its squared SBD to the
+    closest seed picked so far. Series without shape (all zero, e.g. z-scored
+    constant metrics) are at SBD 1 to everything, but would attract no
+    members as seeds, so they are never picked (unless all series are).
+
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]])
+    >>> _kshape_plusplus(x, 2, SpectralCache(x), np.random.RandomState(0))
+    array([[-1.161895  , -0.38729833,  0.38729833,  1.161895  ],
+           [-0.8660254 ,  0.8660254 , -0.8660254 ,  0.8660254 ]])
+    >>> x = np.array([[0,0,0,0], [1,2,3,4], [0,0,0,0], [-1,1,-1,1]])
+    >>> _kshape_plusplus(x, 2, SpectralCache(x), np.random.RandomState(0))
+    array([[-1.161895  , -0.38729833,  0.38729833,  1.161895  ],
+           [-0.8660254 ,  0.8660254 , -0.8660254 ,  0.8660254 ]])
+    """
+    m = x.shape[0]
+    candidates = np.flatnonzero(norm(cache.x, axis=1) > 0)
+    if len(candidates) == 0:
+        candidates = np.arange(m)
+    seeds = [candidates[random_state.randint(len(candidates))]]
+    closest = np.empty(m)
+    closest.fill(np.inf)
+    while len(seeds) < k:
+        ncc = cache.ncc_c_series(seeds[-1:])[0]
+        closest = np.minimum(closest, 1 - ncc[:, 0])
+        weights = np.zeros(m)
+        weights[candidates] = np.clip(closest[candidates], 0, None) ** 2
+        total = weights.sum()
+        if total == 0:
+            seeds.append(candidates[random_state.randint(len(candidates))])
+        else:
+            seeds.append(random_state.choice(m, p=weights / total))
+    return zscore(x[seeds], axis=1, ddof=1, dtype=cache.x.dtype)
+
+def _normalized(c):
+    length = norm(c, axis=1)
+    length[length == 0] = np.inf
+    return c / length[:, None]
+
+def _assign_bounded(cache, idx, upper, lower):
+    """
+    Elkan-style assignment step. upper[i] bounds the SBD of series i to its
+    centroid idx[i] from above, lower[i, j] the SBD to centroid j from below.
+    A centroid that moved by d (between the normalized centroids) changes
+    the NCC to any normalized series, and thus the SBD, by at most d, so the
+    bounds can be carried over from the last iteration. Exact distances to
+    the centroids last passed to the cache are only computed for pairs the
+    bounds cannot rule out; the bounds are tightened in place. Returns the
+    new assignment and the number of exact evaluations.
+
+    >>> x = np.array([[1.,2,3,4], [4,3,2,1]])
+    >>> cache = SpectralCache(x); _ = cache.centroids(x)
+    >>> upper, lower = np.array([0., 0.]), np.array([[0., 0.5], [0.5, 0.]])
+    >>> _assign_bounded(cache, np.array([0, 1]), upper, lower)
+    (array([0, 1]), 0)
+    """
+    m, k = lower.shape
+    rows = np.arange(m)
+    evaluations = 0
+    candidates = lower < upper[:, None]
+    candidates[rows, idx] = False
+
+    # tighten the upper bounds of all series that might move
+    loose = candidates.any(axis=1)
+    for j in range(k):
+        r = rows[loose & (idx == j)]
+        if len(r):
+            upper[r] = lower[r, j] = 1 - cache.ncc_c_to(r, j)
+            evaluations += len(r)
+    candidates &= lower < upper[:, None]
+
+    new_idx = idx.copy()
+    for j in range(k):
+        r = rows[candidates[:, j]]
+        if len(r):
+            lower[r, j] = 1 - cache.ncc_c_to(r, j)
+            evaluations += len(r)
+            r = r[lower[r, j] < upper[r]]
+            new_idx[r] = j
+            upper[r] = lower[r, j]
+    return new_idx, evaluations
 
-def _kshape(x, k, initial_clustering=None):
+def _kshape(x, k, initial_clustering=None, cache=None, random_state=None, seeding="random",
+            prune=True, max_iter=100, initial_centroids=None):
     """
+    Returns the assignment, the centroids and a dict with the number of
+    iterations, the total SBD of the series to their centroids and, per
+    iteration, the number of centroids extracted and of distance
+    evaluations skipped by the bounds of _assign_bounded (if prune is set).
+
+    Only centroids of clusters that gained or lost members in the last
+    iteration are extracted again; the others, and their spectra and
+    distance bounds, are kept.
+
+    With initial_centroids (k x T), the first shapes are extracted aligned
+    to them. Series without an initial assignment (all, or those labeled -1
+    in initial_clustering) start in the cluster of the closest of them.
+    Without them, the labels of initial_clustering are numbered 0..k-1 in
+    their order first, as those of an earlier clustering may skip some.
+
     >>> from numpy.random import seed; seed(0)
-    >>> _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2)
-    (array([0, 0, 1, 0]), array([[-1.2244258 , -0.35015476,  0.52411628,  1.05046429],
+    >>> idx, centroids, info = _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2)
+    >>> idx, centroids
+    (array([0, 0, 1, 0]), array([[-1.19623139, -0.26273649,  0.26273649,  1.19623139],
            [-0.8660254 ,  0.8660254 , -0.8660254 ,  0.8660254 ]]))
+    >>> info["iterations"], info["extracted"], info["pruned"]
+    (2, [2, 2], [0, 1])
+    >>> idx, _, info = _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2,
+    ...                        np.array([0, -1, 1, -1]), initial_centroids=centroids)
+    >>> idx, info["iterations"]
+    (array([0, 0, 1, 0]), 1)
+    >>> idx, _, _ = _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2,
+    ...                     np.array([0, 0, 3, 3]))
+    >>> idx
+    array([0, 0, 1, 0])
     """
     m = x.shape[0]
+    rows = np.arange(m)
+    random_state = _random_state(random_state)
+    if cache is None:
+        cache = SpectralCache(x)
+    assert cache.x.shape == x.shape, "Spectral cache belongs to different series"
 
-    if initial_clustering is not None:
+    dtype = cache.x.dtype
+    centroids = np.zeros((k,x.shape[1]), dtype=dtype)
+
+    if initial_centroids is not None:
+        centroids = np.array(initial_centroids, dtype=dtype)
+        assert centroids.shape == (k, x.shape[1]), "Initial centroids do not match series length"
+        idx = cache.ncc_c(centroids)[0].argmax(1)
+        if initial_clustering is not None:
+            assert len(initial_clustering) == m, "Initial assigment does not match column length"
+            idx = np.where(initial_clustering < 0, idx, initial_clustering)
+    elif initial_clustering is not None:
         assert len(initial_clustering) == m, "Initial assigment does not match column length"
-        idx = initial_clustering
+        labels, idx = np.unique(initial_clustering, return_inverse=True)
+        assert len(labels) <= k, "Initial assignment has more than k clusters"
+    elif seeding == "kshape++":
+        centroids = _kshape_plusplus(x, k, cache, random_state)
+        idx = cache.ncc_c(centroids)[0].argmax(1)
+    elif seeding == "random":
+        idx = random_state.randint(0, k, size=m)
     else:
-        idx = randint(0, k, size=m)
-
-    print(idx)
+        raise ValueError("unknown seeding: %s" % seeding)
 
-    centroids = np.zeros((k,x.shape[1]))
-    distances = np.empty((m, k))
-
-    for _ in range(100):
+    upper = lower = None
+    pruned = []
+    extracted = []
+    changed = np.ones(k, dtype=bool)
+    for iterations in range(1, max_iter + 1):
         old_idx = idx
-        for j in range(k):
-            centroids[j] = _extract_shape(idx, x, j, centroids[j])
+        previous = _normalized(centroids)
+        for j in np.flatnonzero(changed):
+            centroids[j] = _extract_shape(idx, x, j, centroids[j], dtype, cache.max_shift)
+        extracted.append(int(changed.sum()))
 
-        for i in range(m):
-             for j in range(k):
-                 distances[i,j] = 1 - max(_ncc_c(x[i], centroids[j]))
-        idx = distances.argmin(1)
+        if prune and upper is not None:
+            cache.centroids(centroids)
+            drift = norm(_normalized(centroids) - previous, axis=1)
+            upper += drift[idx]
+            lower -= drift
+            idx, evaluations = _assign_bounded(cache, idx, upper, lower)
+            pruned.append(m * k - evaluations)
+        else:
+            lower = 1 - cache.ncc_c(centroids)[0]
+            idx = lower.argmin(1)
+            upper = lower[rows, idx]
+            pruned.append(0)
         if np.array_equal(old_idx, idx):
             break
+        moved = old_idx != idx
+        changed[:] = False
+        changed[old_idx[moved]] = True
+        changed[idx[moved]] = True
 
-    print(idx)
-
-    return idx, centroids
+    sbd = 0
+    for j in range(k):
+        r = rows[idx == j]
+        if len(r):
+            sbd += (1 - cache.ncc_c_to(r, j)).sum()
+    return idx, centroids, dict(iterations=iterations, sbd=sbd, pruned=pruned, extracted=extracted)
 
-def kshape(x, k, initial_clustering=None):
-    idx, centroids = _kshape(np.array(x), k, initial_clustering)
+def _clusters(idx, centroids):
     clusters = []
     for i, centroid in enumerate(centroids):
         series = []
@@ -171,6 +723,510 @@ def kshape(x, k, initial_clustering=None):
         clusters.append((centroid, series))
     return clusters
 
+def kshape(x, k, initial_clustering=None, cache=None, n_init=1,
+           seeding="random", n_jobs=1, random_state=None, prune=True, dtype=None,
+           max_shift=None, return_info=False, initial_centroids=None):
+    """
+    Pass the same SpectralCache to several calls on the same x (e.g. a sweep
+    over k) to transform the series only once.
+
+    With n_init > 1, k-Shape is restarted n_init times (in n_jobs threads,
+    -1 for one per cpu) and the run with the lowest total SBD is kept.
+    seeding is either "random" (random assignment) or "kshape++" (seeds
+    spread out in SBD space). prune skips distance evaluations that cannot
+    change the assignment (see _assign_bounded). If return_info is set, a
+    dict with the iterations, time, total SBD, extracted centroids and
+    pruned evaluations of every restart is returned as well. dtype selects
+    the floating point precision (e.g. np.float32) of the whole computation
+    and max_shift restricts the alignment of series to shifts within
+    +-max_shift samples, if no cache is passed. initial_centroids
+    warm-start k-Shape from known shapes (see _kshape), e.g. those of a
+    previous measurement.
+
+    >>> x = [[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]
+    >>> clusters, info = kshape(x, 2, n_init=3, seeding="kshape++", random_state=0, return_info=True)
+    >>> [series for _, series in clusters]
+    [[0, 1, 3], [2]]
+    >>> len(info["restarts"])
+    3
+    """
+    x = np.array(x)
+    if cache is None:
+        cache = SpectralCache(x, dtype, max_shift)
+    random_state = _random_state(random_state)
+    if initial_clustering is not None or initial_centroids is not None:
+        # all restarts would start from the same assignment
+        n_init = 1
+
+    if n_init == 1:
+        states = [random_state]
+        caches = [cache]
+    else:
+        states = random_state.randint(np.iinfo(np.int32).max, size=n_init)
+        caches = [cache.share() for _ in states]
+
+    def run(args):
+        state, restart_cache = args
+        start = time.time()
+        idx, centroids, info = _kshape(x, k, initial_clustering, restart_cache, state, seeding, prune,
+                                       initial_centroids=initial_centroids)
+        info["time"] = time.time() - start
+        return idx, centroids, info
+
+    if n_jobs == 1 or n_init == 1:
+        runs = [run(args) for args in zip(states, caches)]
+    else:
+        pool = ThreadPool(cpu_count() if n_jobs < 0 else n_jobs)
+        try:
+            runs = pool.map(run, zip(states, caches))
+        finally:
+            pool.close()
+            pool.join()
+    if n_init > 1:
+        for restart_cache in caches:
+            cache.hits += restart_cache.hits
+            cache.misses += restart_cache.misses
+
+    best = int(np.argmin([info["sbd"] for _, _, info in runs]))
+    idx, centroids, _ = runs[best]
+    clusters = _clusters(idx, centroids)
+    if return_info:
+        return clusters, dict(restarts=[info for _, _, info in runs], best=best)
+    return clusters
+
+def paa(x, factor):
+    """
+    Piecewise aggregate approximation: the mean of every factor consecutive
+    samples along the last axis (the last bucket may be shorter).
+
+    >>> paa(np.array([[1,2,3,4,5], [2,2,4,4,6]]), 2)
+    array([[ 1.5,  3.5,  5. ],
+           [ 2. ,  4. ,  6. ]])
+    """
+    x = np.asarray(x)
+    length = x.shape[-1]
+    full = length // factor * factor
+    coarse = x[..., :full].reshape(x.shape[:-1] + (length // factor, factor)).mean(axis=-1)
+    if full < length:
+        rest = x[..., full:].mean(axis=-1)[..., None]
+        coarse = np.concatenate((coarse, rest), axis=-1)
+    return coarse
+
+def multiresolution_kshape(x, k, factor=10, refine_iterations=5, initial_clustering=None,
+                           cache=None, n_init=1, seeding="random", n_jobs=1, random_state=None,
+                           prune=True, dtype=None, max_shift=None, return_info=False,
+                           initial_centroids=None):
+    """
+    Coarse-to-fine k-Shape: kshape() runs to convergence on the PAA of x
+    with buckets of factor samples, then at most refine_iterations
+    iterations on the full resolution start from its assignment. With
+    return_info, the info of the coarse kshape() run is returned with the
+    refinement info under "refine" and the time per stage under "stages".
+    cache is the SpectralCache of the full resolution series. max_shift is
+    scaled down by factor for the coarse stage, as are initial_centroids.
+
+    >>> x = [[0,1,0,-1,0,1,0,-1], [0,1,0,-1,0,1,0,-2],
+    ...      [1,1,1,1,-1,-1,-1,-1], [1,1,1,2,-1,-1,-1,-1]]
+    >>> clusters, info = multiresolution_kshape(x, 2, factor=2, seeding="kshape++", random_state=0, return_info=True)
+    >>> sorted(series for _, series in clusters)
+    [[0, 1], [2, 3]]
+    >>> [name for name, _ in info["stages"]]
+    ['coarse', 'refine']
+    """
+    x = np.array(x)
+    if cache is None:
+        cache = SpectralCache(x, dtype, max_shift)
+    coarse_shift = None
+    if cache.max_shift is not None:
+        coarse_shift = -(-cache.max_shift // factor)
+    start = time.time()
+    coarse = zscore(paa(x, factor), axis=1, dtype=dtype)
+    coarse_centroids = None
+    if initial_centroids is not None:
+        coarse_centroids = zscore(paa(initial_centroids, factor), axis=1, dtype=dtype)
+    clusters, info = kshape(coarse, k, initial_clustering, n_init=n_init, seeding=seeding,
+                            n_jobs=n_jobs, random_state=random_state, prune=prune,
+                            dtype=dtype, max_shift=coarse_shift, return_info=True,
+                            initial_centroids=coarse_centroids)
+    idx = np.zeros(len(x), dtype=int)
+    for j, (_, series) in enumerate(clusters):
+        idx[series] = j
+    coarse_time = time.time() - start
+
+    start = time.time()
+    idx, centroids, refine_info = _kshape(x, k, idx, cache, prune=prune,
+                                          max_iter=refine_iterations)
+    refine_info["time"] = time.time() - start
+    info["refine"] = refine_info
+    info["stages"] = [("coarse", coarse_time), ("refine", refine_info["time"])]
+
+    clusters = _clusters(idx, centroids)
+    if return_info:
+        return clusters, info
+    return clusters
+
+def partitioned_kshape(x, k, partitions, cache=None, refine_iterations=1, n_init=1,
+                       seeding="random", n_jobs=1, random_state=None, prune=True, dtype=None,
+                       max_shift=None, return_info=False):
+    """
+    Two-level k-Shape for many series: kshape() clusters every partition
+    (a list of rows of x, e.g. metrics with similar names) into up to k
+    clusters on its own (in n_jobs threads, -1 for one per cpu), then the
+    centroids of all partitions are clustered into k clusters and every
+    series joins the cluster its partition centroid was merged into. At most
+    refine_iterations iterations on all series start from that assignment.
+    With return_info, the info of the merge kshape() run is returned with
+    the refinement info under "refine", the sizes of the partitions under
+    "partitions" and the time per stage under "stages".
+
+    >>> x = [[0,1,0,-1,0,1,0,-1], [1,1,1,1,-1,-1,-1,-1], [0,1,0,-1,0,1,0,-2],
+    ...      [1,1,1,2,-1,-1,-1,-1], [0,2,0,-1,0,1,0,-1], [1,1,2,1,-1,-1,-1,-1]]
+    >>> clusters, info = partitioned_kshape(x, 2, [[0, 1, 2], [3, 4, 5]], seeding="kshape++",
+    ...                                    random_state=0, return_info=True)
+    >>> sorted(series for _, series in clusters)
+    [[0, 2, 4], [1, 3, 5]]
+    >>> [name for name, _ in info["stages"]]
+    ['partitions', 'merge', 'refine']
+    """
+    x = np.atleast_2d(_as_float(x, dtype))
+    if cache is None:
+        cache = SpectralCache(x, dtype, max_shift)
+    random_state = _random_state(random_state)
+    partitions = [np.asarray(rows, dtype=int) for rows in partitions if len(rows)]
+    states = random_state.randint(np.iinfo(np.int32).max, size=len(partitions))
+    caches = [cache.subset(rows) for rows in partitions]
+
+    def run(args):
+        rows, state, sub_cache = args
+        return kshape(x[rows], min(k, len(rows)), cache=sub_cache, n_init=n_init,
+                      seeding=seeding, random_state=state, prune=prune)
+
+    start = time.time()
+    if n_jobs == 1 or len(partitions) == 1:
+        runs = [run(args) for args in zip(partitions, states, caches)]
+    else:
+        pool = ThreadPool(cpu_count() if n_jobs < 0 else n_jobs)
+        try:
+            runs = pool.map(run, zip(partitions, states, caches))
+        finally:
+            pool.close()
+            pool.join()
+    for sub_cache in caches:
+        cache.hits += sub_cache.hits
+        cache.misses += sub_cache.misses
+    centroids = []
+    members = []
+    for rows, clusters in zip(partitions, runs):
+        for centroid, series in clusters:
+            if len(series):
+                centroids.append(centroid)
+                members.append(rows[series])
+    partitions_time = time.time() - start
+
+    start = time.time()
+    centroids = np.array(centroids)
+    merged, info = kshape(centroids, min(k, len(centroids)), n_init=n_init, seeding=seeding,
+                          n_jobs=n_jobs, random_state=random_state, prune=prune,
+                          max_shift=cache.max_shift, return_info=True)
+    idx = np.zeros(len(x), dtype=int)
+    for j, (_, series) in enumerate(merged):
+        for i in series:
+            idx[members[i]] = j
+    merge_time = time.time() - start
+
+    start = time.time()
+    idx, centroids, refine_info = _kshape(x, len(merged), idx, cache, prune=prune,
+                                          max_iter=refine_iterations)
+    refine_info["time"] = time.time() - start
+    info["refine"] = refine_info
+    info["partitions"] = [len(rows) for rows in partitions]
+    info["stages"] = [("partitions", partitions_time), ("merge", merge_time),
+                      ("refine", refine_info["time"])]
+
+    clusters = _clusters(idx, centroids)
+    if return_info:
+        return clusters, info
+    return clusters
+
+def _margins(sbd, idx):
+    """
+    SBD of every series to the closest centroid other than its own minus
+    the SBD to its own centroid (inf for a single centroid), given the
+    (series x centroids) SBD matrix
+
+    >>> _margins(np.array([[0.1, 0.3, 0.5], [0.4, 0.2, 0.25]]), np.array([0, 1]))
+    array([ 0.2 ,  0.05])
+    """
+    rows = np.arange(len(idx))
+    own = sbd[rows, idx]
+    others = np.array(sbd, dtype=float)
+    others[rows, idx] = np.inf
+    return others.min(axis=1) - own
+
+def simplified_silhouette(sbd, margins, idx):
+    """
+    Mean simplified silhouette of a clustering, given the SBD of every
+    series to its own centroid and its margin (see _margins): the closest
+    other centroid takes the place of the closest other cluster, so only the
+    series x centroids distances are needed. Like the silhouette, series in
+    single member clusters score 0 and a single cluster (or one cluster per
+    series) scores -1.
+
+    >>> print("%.4f" % simplified_silhouette(np.array([0.1, 0.2, 0.3, 0.1]),
+    ...                                      np.array([0.2, 0.05, -0.1, 0.3]),
+    ...                                      np.array([0, 0, 1, 1])))
+    0.3208
+    >>> simplified_silhouette(np.array([0.1, 0.2]), np.array([0.2, 0.05]), np.array([0, 1]))
+    -1
+    """
+    idx = np.asarray(idx)
+    labels, counts = np.unique(idx, return_counts=True)
+    if len(labels) == 1 or len(labels) >= len(idx):
+        return -1
+    own = np.asarray(sbd, dtype=float)
+    other = own + margins
+    scale = np.maximum(own, other)
+    s = np.zeros(len(idx))
+    valid = (scale > 0) & np.in1d(idx, labels[counts > 1])
+    s[valid] = margins[valid] / scale[valid]
+    return s.mean()
+
+def incremental_kshape(x, labels, centroids, margins, threshold=0.05, cache=None, dtype=None,
+                       max_shift=None, return_info=False):
+    """
+    Updates a clustering after samples were appended to the series. x are
+    the series over the extended window; labels, centroids and margins (see
+    _margins) are the result on the previous, shorter window, with label -1
+    for series that were not clustered before.
+
+    The centroids, padded with zeros, are extracted again from their
+    previous members. Only series with a margin below threshold (and new
+    series) are compared to all centroids and reassigned; afterwards the
+    centroids of clusters that changed are extracted once more. Returns the
+    clusters like kshape() and the margins of the series: exact for the
+    reassigned series, carried over for the others. With return_info, a
+    dict with the number of reassigned and moved series is returned as
+    well.
+
+    >>> x = zscore(np.array([[0,1,0,-1,0,1,0,-1,0,1], [0,1,0,-1,0,1,0,-2,0,1],
+    ...                      [1,1,1,1,-1,-1,-1,-1,1,1], [1,1,1,2,-1,-1,-1,-1,1,1]]), axis=1)
+    >>> centroids = x[[0, 2], :8]
+    >>> clusters, margins = incremental_kshape(x, [0, -1, 1, 1], centroids, [1, 0, 1, 0.01])
+    >>> [series for _, series in clusters]
+    [[0, 1], [2, 3]]
+    >>> margins[[0, 2]]
+    array([ 1.,  1.])
+    """
+    x = np.atleast_2d(_as_float(x, dtype))
+    if cache is None:
+        cache = SpectralCache(x, dtype, max_shift)
+    m, length = x.shape
+    idx = np.array(labels, dtype=int)
+    margins = np.array(margins, dtype=float)
+    centroids = np.atleast_2d(centroids)
+    k = len(centroids)
+
+    extended = np.zeros((k, length), dtype=x.dtype)
+    extended[:, :centroids.shape[1]] = centroids[:, :length]
+    for j in range(k):
+        extended[j] = _extract_shape(idx, x, j, extended[j], dtype, cache.max_shift)
+
+    unstable = np.flatnonzero((margins < threshold) | (idx < 0))
+    old_idx = idx.copy()
+    if len(unstable):
+        sbd = 1 - cache.ncc_c(extended, unstable)[0]
+        idx[unstable] = sbd.argmin(axis=1)
+        margins[unstable] = _margins(sbd, idx[unstable])
+
+    moved = np.flatnonzero(old_idx != idx)
+    changed = (set(idx[moved]) | set(old_idx[moved])) - set([-1])
+    for j in sorted(changed):
+        extended[j] = _extract_shape(idx, x, j, extended[j], dtype, cache.max_shift)
+
+    clusters = _clusters(idx, extended)
+    if return_info:
+        return clusters, margins, dict(reassigned=len(unstable), moved=len(moved))
+    return clusters, margins
+
+def bisecting_kshape(x, max_k, cache=None, n_init=1, random_state=None, prune=True,
+                     dtype=None, max_shift=None, return_info=False, split_retries=3):
+    """
+    Bisecting k-Shape: starting from a single cluster, the cluster with the
+    largest total SBD of its members to its centroid is split in two with
+    kshape() (kshape++ seeding, n_init restarts) until there are max_k
+    clusters or no cluster can be split any more. A split that leaves one
+    half empty is retried split_retries times with fresh seeds before the
+    cluster counts as unsplittable. Returns the clusters
+    (like kshape()) for every k = 1, 2, ... on the way. With return_info, a
+    dict with the total SBD for every k, the cluster split to get there and
+    the time is returned as well.
+
+    >>> x = [[0,1,0,-1,0,1,0,-1], [0,1,0,-1,0,1,0,-2],
+    ...      [1,1,1,1,-1,-1,-1,-1], [1,1,1,2,-1,-1,-1,-1]]
+    >>> results, info = bisecting_kshape(x, 3, random_state=0, return_info=True)
+    >>> [sorted(series for _, series in clusters) for clusters in results]
+    [[[0, 1, 2, 3]], [[0, 1], [2, 3]], [[0], [1], [2, 3]]]
+    >>> info["split"]
+    [None, 0, 0]
+    """
+    x = np.atleast_2d(_as_float(x, dtype))
+    if cache is None:
+        cache = SpectralCache(x, dtype, max_shift)
+    random_state = _random_state(random_state)
+    m = len(x)
+    start = time.time()
+
+    def cohesion(rows, centroid):
+        if len(rows) == 0:
+            return 0
+        return (1 - cache.ncc_c(centroid[None, :], rows)[0][:, 0]).sum()
+
+    idx = np.zeros(m, dtype=int)
+    centroids = [_extract_shape(idx, x, 0, np.zeros(x.shape[1]), dtype, cache.max_shift)]
+    sbd = [cohesion(np.arange(m), centroids[0])]
+    splittable = [m > 1]
+    results = [_clusters(idx, centroids)]
+    info = dict(sbd=[sum(sbd)], split=[None])
+
+    while len(centroids) < max_k and any(splittable):
+        j = max(np.flatnonzero(splittable), key=lambda c: sbd[c])
+        rows = np.flatnonzero(idx == j)
+        sub_cache = cache.subset(rows)
+        for _ in range(1 + split_retries):
+            halves = kshape(x[rows], 2, cache=sub_cache, n_init=n_init, seeding="kshape++",
+                            random_state=random_state, prune=prune)
+            if min(len(series) for _, series in halves) > 0:
+                break
+        cache.hits += sub_cache.hits
+        cache.misses += sub_cache.misses
+        if min(len(series) for _, series in halves) == 0:
+            splittable[j] = False
+            continue
+
+        (first, first_series), (second, second_series) = halves
+        new = len(centroids)
+        idx[rows[second_series]] = new
+        centroids[j] = first
+        centroids.append(second)
+        sbd[j] = cohesion(rows[first_series], first)
+        sbd.append(cohesion(rows[second_series], second))
+        splittable[j] = len(first_series) > 1
+        splittable.append(len(second_series) > 1)
+        results.append(_clusters(idx, centroids))
+        info["sbd"].append(sum(sbd))
+        info["split"].append(j)
+
+    info["time"] = time.time() - start
+    if return_info:
+        return results, info
+    return results
+
+def _minibatch_assign(chunks, centroids, max_shift=None):
+    idx = []
+    sbd = 0
+    for block in chunks:
+        distances = _sbd_matrix(block, centroids, max_shift=max_shift)[0]
+        block_idx = distances.argmin(1)
+        sbd += distances[np.arange(len(block_idx)), block_idx].sum()
+        idx.append(block_idx)
+    return np.concatenate(idx), sbd
+
+def minibatch_kshape(chunks, k, batch_size=64, window=None, max_passes=10,
+                     tol=0.01, random_state=None, dtype=None, return_info=False,
+                     max_shift=None):
+    """
+    Mini-batch variant of k-Shape for inputs too large to re-align as a
+    whole on every iteration.
+
+    chunks is an iterable of (rows x T) blocks of the input series, or a
+    callable that returns a fresh one for every pass. A one-shot iterator
+    (e.g. a generator) is consumed by a single pass, whatever max_passes,
+    and the assignment made during that pass is returned. Otherwise the
+    series are assigned to the final centroids once more. Every block is assigned to the current centroids and
+    split into random mini-batches of batch_size series. For each mini-batch
+    a random time window of window samples (default: all of T) is aligned
+    and its shape blended into the centroids, weighted by the number of
+    series the centroid has absorbed so far. Iteration stops after
+    max_passes passes or once less than a fraction tol of the series change
+    their cluster in a pass. max_shift restricts the alignment of series to
+    shifts within +-max_shift samples. The result has the same format as
+    kshape().
+
+    >>> x = np.array([[0,1,0,-1,0,1,0,-1], [0,1,0,-1,0,1,0,-2],
+    ...               [1,1,1,1,-1,-1,-1,-1], [1,1,1,2,-1,-1,-1,-1]])
+    >>> clusters = minibatch_kshape([x[:2], x[2:]], 2, batch_size=2, window=6, random_state=0)
+    >>> sorted(series for _, series in clusters)
+    [[0, 1], [2, 3]]
+    >>> clusters = minibatch_kshape(iter([x[::2], x[1::2]]), 2, batch_size=2, random_state=0)
+    >>> sorted(series for _, series in clusters)
+    [[0, 2], [1, 3]]
+    """
+    one_shot = not callable(chunks) and iter(chunks) is chunks
+    if one_shot:
+        max_passes = 1
+    blocks = chunks if callable(chunks) else lambda: chunks
+    random_state = _random_state(random_state)
+    centroids = None
+    counts = np.zeros(k)
+    idx = None
+    info = dict(passes=0, batches=0)
+    start = time.time()
+
+    for _ in range(max_passes):
+        new_idx = []
+        sbd = 0
+        for block in blocks():
+            block = np.atleast_2d(_as_float(block, dtype))
+            length = block.shape[1]
+            if centroids is None:
+                centroids = _kshape_plusplus(block, k, SpectralCache(block, max_shift=max_shift),
+                                             random_state)
+            w = length if window is None else min(window, length)
+            distances = _sbd_matrix(block, centroids, max_shift=max_shift)[0]
+            block_idx = distances.argmin(1)
+            sbd += distances[np.arange(len(block_idx)), block_idx].sum()
+            new_idx.append(block_idx)
+
+            order = random_state.permutation(len(block))
+            for b in range(0, len(order), batch_size):
+                rows = order[b:b + batch_size]
+                offset = random_state.randint(length - w + 1)
+                batch = block[rows, offset:offset + w]
+                for j in np.unique(block_idx[rows]):
+                    members = (block_idx[rows] == j).sum()
+                    current = centroids[j, offset:offset + w]
+                    shape = _extract_shape(block_idx[rows], batch, j, current, block.dtype,
+                                           max_shift)
+                    # the extracted shape is z-normalized over the window
+                    # only, keep the level of the rest of the centroid
+                    if w < length and current.std() > 0:
+                        shape = shape * current.std() + current.mean()
+                    counts[j] += members
+                    eta = float(members) / counts[j]
+                    current *= (1 - eta)
+                    current += eta * shape
+                info["batches"] += 1
+        centroids = zscore(centroids, axis=1, ddof=1)
+        info["passes"] += 1
+
+        new_idx = np.concatenate(new_idx)
+        if idx is not None and (new_idx != idx).mean() < tol:
+            idx = new_idx
+            break
+        idx = new_idx
+
+    if one_shot:
+        # consumed already, keep the assignment of the pass
+        info["sbd"] = sbd
+    else:
+        # the assignment of the last pass predates its centroid updates
+        idx, info["sbd"] = _minibatch_assign(blocks(), centroids, max_shift)
+    info["time"] = time.time() - start
+    clusters = _clusters(idx, centroids)
+    if return_info:
+        return clusters, info
+    return clusters
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -1,23 +1,18 @@
-import os
 import sys
-import json
 
 import pandas as pd
 from plot import plt, sns
 
 from kshape import kshape, zscore
-
-def load_metadata(path):
-    with open(os.path.join(path, "metadata.json")) as f:
-        return json.load(f)
+import metadata
+import cluster_artifact
 
 def centroids(path):
-    metadata = load_metadata(path)
+    data = metadata.load(path)
     d = {}
-    for srv in metadata["services"]:
-        name = "%s/%s-cluster-1_1.tsv" % (path, srv["name"])
-        df = pd.read_csv(name, sep="\t", index_col='time', parse_dates=True)
-        d[srv["name"]] = df.centroid
+    for srv in data["services"]:
+        artifact = cluster_artifact.load(cluster_artifact.name(path, srv["name"], 1))
+        d[srv["name"]] = pd.Series(artifact.centroids[0], index=artifact.time)
     df2 = pd.DataFrame(d)
     df2 = df2.fillna(method="bfill", limit=1e9)
     df2 = df2.fillna(method="ffill", limit=1e9)
@@ -3,13 +3,42 @@ import tempfile
 import os
 import json
 import fcntl
+import sqlite3
 from collections import OrderedDict
 
+# the metadata of a measurement is kept in metadata.json or, once imported
+# (see import_json), in metadata.sqlite: one row per service, so that
+# concurrent workers only read and write the services they work on.
+DATABASE = "metadata.sqlite"
+# seconds to wait for the write lock of the database
+DATABASE_TIMEOUT = 600
+
+def _database(path):
+    p = os.path.join(path, DATABASE)
+    if os.path.exists(p):
+        return p
+    return None
+
 def load(path):
+    db = _database(path)
+    if db is not None:
+        conn = sqlite3.connect(db, timeout=DATABASE_TIMEOUT)
+        try:
+            return _read(conn)
+        finally:
+            conn.close()
     with open(os.path.join(path, "metadata.json")) as f:
         return json.load(f)
 
 def save(path, metadata):
+    db = _database(path)
+    if db is not None:
+        with _transaction(db) as conn:
+            _write(conn, metadata)
+        return
+    _save_json(path, metadata)
+
+def _save_json(path, metadata):
     p = os.path.join(path, "metadata.json")
     with _atomic_write(p) as f:
         # http://www.psf.upfronthosting.co.za/issue25457
@@ -24,7 +53,15 @@ def update(path):
     """
     allow concurrent update of metadata
     """
-    p = os.path.join(path, "metadata.json")
+    db = _database(path)
+    if db is not None:
+        with _transaction(db) as conn:
+            data = _read(conn)
+            yield(data)
+            _write(conn, data)
+        return
+    # metadata.json is replaced on save, so lock a file that stays
+    p = os.path.join(path, "metadata.json.lock")
     # we have to open writeable to get a lock
     with open(p, "a") as f:
         fcntl.lockf(f, fcntl.LOCK_EX)
@@ -33,6 +70,106 @@ def update(path):
         save(path, data)
         fcntl.lockf(f, fcntl.LOCK_UN)
 
+@contextmanager
+def update_service(path, name):
+    """
+    allow concurrent update of the metadata of a single service. with the
+    database, only the row of this service is read and written.
+    """
+    db = _database(path)
+    if db is None:
+        with update(path) as data:
+            for srv in data["services"]:
+                if srv["name"] == name:
+                    yield(srv)
+                    break
+            else:
+                raise KeyError("no service %s in %s" % (name, path))
+        return
+    with _transaction(db) as conn:
+        row = conn.execute("SELECT data FROM services WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError("no service %s in %s" % (name, path))
+        srv = json.loads(row[0])
+        yield(srv)
+        conn.execute("UPDATE services SET data = ? WHERE name = ?", (_dumps(srv), name))
+
+@contextmanager
+def _transaction(db):
+    conn = sqlite3.connect(db, timeout=DATABASE_TIMEOUT, isolation_level=None)
+    try:
+        # take the write lock upfront, readers are not blocked until commit
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def _dumps(data):
+    return json.dumps(data, sort_keys=True)
+
+def _create(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS services "
+                 "(name TEXT PRIMARY KEY, position INTEGER, data TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS properties (key TEXT PRIMARY KEY, data TEXT)")
+
+def _read(conn):
+    data = {}
+    for key, value in conn.execute("SELECT key, data FROM properties"):
+        data[key] = json.loads(value)
+    data["services"] = [json.loads(value) for (value,) in
+                        conn.execute("SELECT data FROM services ORDER BY position")]
+    return data
+
+def _write(conn, metadata):
+    """
+    replace the content of the database with metadata, rows that did not
+    change are left untouched
+    """
+    old = dict(conn.execute("SELECT name, data FROM services"))
+    names = set()
+    for position, srv in enumerate(metadata["services"]):
+        names.add(srv["name"])
+        value = _dumps(srv)
+        if old.get(srv["name"]) != value:
+            conn.execute("INSERT OR REPLACE INTO services (name, position, data) VALUES (?, ?, ?)",
+                         (srv["name"], position, value))
+        else:
+            conn.execute("UPDATE services SET position = ? WHERE name = ?", (position, srv["name"]))
+    for name in set(old) - names:
+        conn.execute("DELETE FROM services WHERE name = ?", (name,))
+
+    conn.execute("DELETE FROM properties")
+    for key, value in metadata.items():
+        if key != "services":
+            conn.execute("INSERT INTO properties (key, data) VALUES (?, ?)", (key, _dumps(value)))
+
+def import_json(path):
+    """
+    move the metadata of path from metadata.json into the database
+    """
+    with open(os.path.join(path, "metadata.json")) as f:
+        data = json.load(f)
+    db = os.path.join(path, DATABASE)
+    conn = sqlite3.connect(db, timeout=DATABASE_TIMEOUT)
+    try:
+        _create(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    with _transaction(db) as conn:
+        _write(conn, data)
+
+def export_json(path):
+    """
+    write the legacy metadata.json of path from the database
+    """
+    _save_json(path, load(path))
+
 @contextmanager
 def _atomic_write(filename):
     path = os.path.dirname(filename)
@@ -53,8 +190,16 @@ def _atomic_write(filename):
 if __name__ == "__main__":
     import sys
     if len(sys.argv) < 2:
-        sys.stderr.write("USAGE: %s measurment...\n" % sys.argv[0])
+        sys.stderr.write("USAGE: %s [import|export] measurment...\n" % sys.argv[0])
         sys.exit(1)
-    for arg in sys.argv[1:]:
-        with update(arg) as m:
-            pass
+    command = None
+    if sys.argv[1] in ["import", "export"]:
+        command = sys.argv[1]
+    for arg in sys.argv[2 if command else 1:]:
+        if command == "import":
+            import_json(arg)
+        elif command == "export":
+            export_json(arg)
+        else:
+            with update(arg) as m:
+                pass
@@ -41,7 +41,8 @@ def get_cluster_metrics(data, service_name):
                 if "rep_metrics" in cluster:
                     rep_metrics = {}
                     rep_metrics = cluster["rep_metrics"]
-                    silhouette_score = cluster["silhouette_score"]
+                    silhouette_score = cluster.get("silhouette_score",
+                                                   cluster.get("simplified_silhouette_score"))
 
                     for cluster_id in cluster["metrics"]:
 
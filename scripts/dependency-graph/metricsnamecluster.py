@@ -64,8 +64,8 @@ def cluster_of_size(linkage_matrix, size):
     unassigned_num = elements
     for i, assignment in enumerate(linkage_matrix):
         a, b, _, _ = assignment
-        a = int(a - 1)
-        b = int(b - 1)
+        a = int(a)
+        b = int(b)
         j = i + elements
         if a < elements and b < elements:
             clusters[j] = [a, b]
@@ -0,0 +1,59 @@
+import os
+import sys
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+import metadata
+from kshape import kshape, zscore
+
+def cluster_labels(clusters, size):
+    labels = np.zeros(size, dtype=int)
+    for i, (_, series) in enumerate(clusters):
+        labels[series] = i
+    return labels
+
+def compare_service(path, service, res, cluster_sizes=range(2, 7), random_state=0):
+    """
+    cluster a service in double and single precision, starting from the same
+    random assigment, and record how much the assigments differ
+    """
+    filename = os.path.join(path, service["preprocessed_filename"])
+    df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    size = len(df.columns)
+    for n in cluster_sizes:
+        if n > size:
+            break
+        labels = {}
+        for dtype in [np.float64, np.float32]:
+            matrix = [zscore(df[c], dtype=dtype) for c in df.columns]
+            clusters = kshape(matrix, n, random_state=random_state, dtype=dtype)
+            labels[dtype] = cluster_labels(clusters, size)
+        res["name"].append(service["name"])
+        res["cluster"].append(n)
+        res["metrics"].append(size)
+        res["differing_metrics"].append(int((labels[np.float64] != labels[np.float32]).sum()))
+        res["adjusted_rand_score"].append(adjusted_rand_score(labels[np.float64], labels[np.float32]))
+
+def main(path):
+    data = metadata.load(path)
+    result = defaultdict(list)
+    for srv in data["services"]:
+        print(srv["name"])
+        compare_service(path, srv, result)
+    df = pd.DataFrame(result)
+    n = os.path.join(path, "precision.tsv")
+    print(n)
+    df.to_csv(n, sep="\t")
+
+    differing = (df.adjusted_rand_score < 1).sum()
+    print("float32 assigment differs in %d/%d clusterings, %d/%d metric assigments differ"
+          % (differing, len(df), df.differing_metrics.sum(), df.metrics.sum()))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write("USAGE: %s measurement\n" % sys.argv[0])
+        sys.exit(1)
+    main(sys.argv[1])
@@ -61,6 +61,7 @@ def apply(path):
         df3.to_csv(os.path.join(path, newname), sep="\t", compression='gzip')
         service["preprocessed_filename"] = newname
         service["preprocessed_fields"] = list(df3.columns)
+        service["preprocessed_samples"] = len(df3)
         service.update(classes)
     metadata.save(path, data)
 
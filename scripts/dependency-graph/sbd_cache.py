@@ -0,0 +1,139 @@
+"""
+on-disk cache of the pairwise SBD of the metrics of a service.
+
+entries are keyed by a hash of the preprocessed file and the distance
+parameters, stored as condensed vectors (see kshape._sbd_pdist) in .npy files
+in the sbd-cache directory of the measurement and loaded memory mapped. all
+entries, across measurements, are listed in a shared index; once they exceed
+SBD_CACHE_MAX_BYTES, the least recently used ones are removed.
+
+the cache is best-effort: entries that cannot be read or written (e.g. in a
+read-only measurement) are recomputed, never fatal.
+"""
+import os
+import sys
+import fcntl
+import hashlib
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = "sbd-cache"
+MAX_BYTES = int(os.environ.get("SBD_CACHE_MAX_BYTES", 4 << 30))
+INDEX = os.environ.get("SBD_CACHE_INDEX",
+                       os.path.expanduser("~/.cache/rca-evaluation/sbd-cache.index"))
+
+def key(filename, dtype=None, max_shift=None, dedup_threshold=None, columns=None):
+    """
+    hash of the content of filename and the distance parameters. with
+    dedup_threshold, the distances are those of the metrics left after
+    removing duplicates (see dedup), named by columns.
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    params = "dtype=%s max_shift=%s" % (np.dtype(dtype or float).name, max_shift)
+    if dedup_threshold is not None:
+        params += " dedup=%s" % dedup_threshold
+    if columns is not None:
+        params += " columns=%s" % "\t".join(columns)
+    h.update(params.encode("utf-8"))
+    return h.hexdigest()
+
+def _path(path, k):
+    return os.path.join(os.path.abspath(path), CACHE_DIR, k + ".npy")
+
+def load(path, k):
+    """
+    the cached distances for key k of the measurement path, memory mapped,
+    or None
+    """
+    p = _path(path, k)
+    try:
+        distances = np.load(p, mmap_mode="r")
+    except (IOError, OSError, ValueError):
+        return None
+    # the modification time is the recency used for eviction
+    try:
+        os.utime(p, None)
+    except (IOError, OSError):
+        pass
+    return distances
+
+def store(path, k, distances):
+    """
+    write the distances for key k of the measurement path and evict the
+    least recently used entries if the cache grew too large. failures are
+    reported, but not raised.
+    """
+    try:
+        _store(path, k, distances)
+    except (IOError, OSError) as e:
+        sys.stderr.write("sbd_cache: cannot store %s: %s\n" % (k, e))
+
+def _store(path, k, distances):
+    p = _path(path, k)
+    if os.path.exists(p):
+        os.utime(p, None)
+        return
+    directory = os.path.dirname(p)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created concurrently
+            if not os.path.isdir(directory):
+                raise
+    f = tempfile.NamedTemporaryFile(delete=False, dir=directory, suffix=".tmp")
+    try:
+        np.save(f, np.asarray(distances))
+        f.close()
+        os.rename(f.name, p)
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+    try:
+        _register(p)
+    except (IOError, OSError) as e:
+        # the entry is usable, but not evicted with the others
+        sys.stderr.write("sbd_cache: cannot update the index %s: %s\n" % (INDEX, e))
+
+def _register(p):
+    index_dir = os.path.dirname(INDEX)
+    if index_dir and not os.path.isdir(index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            if not os.path.isdir(index_dir):
+                raise
+    with open(INDEX, "a+") as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        f.seek(0)
+        entries = set(line.strip() for line in f if line.strip())
+        entries.add(p)
+
+        stats = []
+        for entry in entries:
+            try:
+                st = os.stat(entry)
+            except OSError:
+                continue
+            stats.append((st.st_mtime, st.st_size, entry))
+        stats.sort()
+        total = sum(size for _, size, _ in stats)
+        # never evict the entry just written
+        while total > MAX_BYTES and len(stats) > 1:
+            _, size, entry = stats.pop(0)
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+        f.seek(0)
+        f.truncate()
+        for _, _, entry in stats:
+            f.write(entry + "\n")
+        f.flush()
+        fcntl.lockf(f, fcntl.LOCK_UN)
@@ -0,0 +1,60 @@
+"""
+preprocessed metrics of the services of a measurement, parsed once and
+shared with the clustering workers.
+
+every service is written to an uncompressed .npz file (time, columns and
+the values as time x metrics matrix) in a temporary directory, by default
+in /dev/shm. workers only get a Handle to it and map the file into memory
+(see cluster_artifact._map_npz) instead of parsing the gzipped tsv again.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import cluster_artifact
+
+SHARED_DIR = os.environ.get("SHARED_DATASET_DIR",
+                            "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+class Handle(object):
+    """
+    reference to the shared metrics of a service, cheap to pickle
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def frame(self):
+        """
+        the metrics as data frame, like the preprocessed tsv. the values are
+        a read-only view of the shared file.
+        """
+        arrays = cluster_artifact._map_npz(self.filename)
+        return pd.DataFrame(arrays["values"], index=pd.DatetimeIndex(arrays["time"], name="time"),
+                            columns=[str(c) for c in arrays["columns"]])
+
+class SharedDataset(object):
+    """
+    temporary directory of the shared services, removed by close()
+    """
+    def __init__(self, directory=SHARED_DIR):
+        self.directory = tempfile.mkdtemp(prefix="rca-dataset-", dir=directory)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def share(directory, filename):
+    """
+    parse the preprocessed tsv filename into directory and return its Handle
+    """
+    df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    f = tempfile.NamedTemporaryFile(delete=False, dir=directory, suffix=".npz")
+    try:
+        np.savez(f, time=np.asarray(df.index, dtype="datetime64[ns]"),
+                 columns=np.array([u"%s" % c for c in df.columns]),
+                 values=np.ascontiguousarray(df.values))
+    finally:
+        f.close()
+    return Handle(f.name)
@@ -0,0 +1,117 @@
+import os
+import sys
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import silhouette_score
+
+import metadata
+import cluster_artifact
+from calculate_indexes import service_distances
+from kshape import SpectralCache, simplified_silhouette, zscore, _margins
+
+def read_clustering(path, cluster):
+    """
+    metric names, z-scored series, labels and centroids of a clustering,
+    from the cluster artifact or, for older measurements, from the cluster
+    files. None if neither was written.
+    """
+    if "artifact" in cluster:
+        artifact = cluster_artifact.load(os.path.join(path, cluster["artifact"]))
+        return ([str(c) for c in artifact.columns], np.asarray(artifact.series),
+                np.asarray(artifact.labels), np.asarray(artifact.centroids))
+    if "filenames" not in cluster:
+        return None
+    columns, series, labels, centroids = [], [], [], []
+    for j, filename in enumerate(cluster["filenames"]):
+        df = pd.read_csv(os.path.join(path, filename), sep="\t", index_col='time', parse_dates=True)
+        centroids.append(df.centroid.values)
+        for c in df.columns.drop("centroid"):
+            columns.append(c)
+            series.append(zscore(df[c].values))
+            labels.append(j)
+    return columns, np.array(series), np.array(labels), np.array(centroids)
+
+def compare_service(path, service, res):
+    """
+    score every clustering of a service with the exact and the simplified
+    silhouette and record the cluster size each of them prefers. the exact
+    score is the one recorded by cluster.py, if any.
+    """
+    distances = None
+    scores = {}
+    for key in sorted(service.get("clusters", {}), key=int):
+        cluster = service["clusters"][key]
+        clustering = None
+        if int(key) >= 2:
+            clustering = read_clustering(path, cluster)
+        if clustering is None:
+            continue
+        columns, series, labels, centroids = clustering
+        if "silhouette_score" in cluster:
+            exact = cluster["silhouette_score"]
+        elif len(np.unique(labels)) == 1 or len(np.unique(labels)) >= len(labels):
+            exact = -1
+        else:
+            if distances is None:
+                distances, distance_columns = service_distances(path, service)
+                positions = dict((c, i) for i, c in enumerate(distance_columns))
+            rows = [positions[c] for c in columns]
+            exact = silhouette_score(distances[np.ix_(rows, rows)], labels, metric='precomputed')
+        # margins to all other centroids, as incremental updates only keep
+        # them for the metrics that moved
+        ncc, _ = SpectralCache(series).ncc_c(centroids)
+        sbd = 1 - ncc
+        rows = np.arange(len(labels))
+        simplified = simplified_silhouette(sbd[rows, labels], _margins(sbd, labels), labels)
+        scores[int(key)] = (exact, simplified)
+        res["name"].append(service["name"])
+        res["cluster"].append(key)
+        res["metrics"].append(len(labels))
+        res["silhouette_score"].append(exact)
+        res["simplified_silhouette_score"].append(simplified)
+        res["best_cluster"].append(None)
+        res["simplified_best_cluster"].append(None)
+    if not scores:
+        return
+    exact_k = max(scores, key=lambda k: scores[k][0])
+    simplified_k = max(scores, key=lambda k: scores[k][1])
+    res["name"].append(service["name"])
+    res["cluster"].append("best")
+    res["metrics"].append(res["metrics"][-1])
+    res["silhouette_score"].append(scores[exact_k][0])
+    res["simplified_silhouette_score"].append(scores[simplified_k][1])
+    res["best_cluster"].append(exact_k)
+    res["simplified_best_cluster"].append(simplified_k)
+
+def main(paths):
+    agree, total = 0, 0
+    for path in paths:
+        data = metadata.load(path)
+        result = defaultdict(list)
+        for srv in data["services"]:
+            print(srv["name"])
+            compare_service(path, srv, result)
+        df = pd.DataFrame(result)
+        n = os.path.join(path, "silhouette.tsv")
+        print(n)
+        df.to_csv(n, sep="\t", index=False)
+
+        if len(df) == 0:
+            continue
+        best = df[df.cluster == "best"]
+        same = int((best.best_cluster == best.simplified_best_cluster).sum())
+        print("%s: simplified silhouette picks the same cluster size for %d/%d services"
+              % (path, same, len(best)))
+        agree += same
+        total += len(best)
+    if len(paths) > 1:
+        print("simplified silhouette picks the same cluster size for %d/%d services"
+              % (agree, total))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write("USAGE: %s measurement...\n" % sys.argv[0])
+        sys.exit(1)
+    main(sys.argv[1:])